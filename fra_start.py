@@ -19,6 +19,7 @@ import sys
 
 import tools.helper as tools
 from config import config
+from tools.session import Session
 
 fd = config.var
 
@@ -44,32 +45,49 @@ def start(stamp, sequence, para, scenarios, st_flds, paths):
     else:
         pass
 
+    # The results of DOF, DOR and SED are handed over to the next stages in
+    # memory. The stream feature class is updated once, at the end of a
+    # successful run, unless write_back is set to "no"
+    write_back = tools.get_para(para, "write_back", "yes")
+
+    # The dam table is read once, with the fields of all stages
+    dam_fields = [fd.BAS_ID, fd.GOID, fd.NOID, fd.STOR_MCM, fd.DFU, fd.DFD,
+                  fd.INC, para["barrier_inc_field"], para["svol_field"]]
+
+    session = Session(para["streams_fc"], write_back.lower() == "yes",
+                      dam_fields)
+
     if sequence["run_dof"] == "YES":
         prt('\n' + "*********")
         prt("RUN DOF")
         prt("*********" + '\n')
 
-        ffr_run_dof.run_dof(stamp, para, paths)
+        ffr_run_dof.run_dof(stamp, para, paths, session)
     if sequence["run_dor"] == "YES":
         prt('\n' + "*********")
         prt("RUN DOR")
         prt("*********" + '\n')
 
-        ffr_run_dor.run_dor(stamp, para, paths)
+        ffr_run_dor.run_dor(stamp, para, paths, session)
 
     if sequence["run_sed"] == "YES":
         prt('\n' + "*********")
         prt("RUN SED")
         prt("*********" + '\n')
 
-        ffr_run_sed.run_sed(para, paths)
+        ffr_run_sed.run_sed(para, paths, session)
 
     if sequence["run_csi"] == "YES":
         prt('\n' + "*********")
         prt("RUN CSI")
         prt("*********" + '\n')
 
-        ffr_run_csi.run_csi(stamp, para, scenarios, st_flds, paths)
+        ffr_run_csi.run_csi(stamp, para, scenarios, st_flds, paths,
+                            session)
+
+    # Only the results of a run in which all stages succeeded are written
+    # back. If a stage fails, its exception is raised without writing
+    session.flush()
 
 
 def setup(base, out, xls_full, stamp, xls_file_name):
@@ -1,13 +1,16 @@
+import hashlib
 import math
-import sys
 
+import numpy as np
+
+import tools.topology as topology
 from config import config
 
 fd = config.var
 
 
 def calculate_DOF(dams, streams, mode, dof_field, drf_upstream, drf_downstream,
-                  use_dam_level_df):
+                  use_dam_level_df, topo=None, cache=None, drf_sweep=None):
     """
     Calculates the degree of fragmentation (DOF) given a set of dams
 
@@ -24,25 +27,44 @@ def calculate_DOF(dams, streams, mode, dof_field, drf_upstream, drf_downstream,
     :param use_dam_level_df: If true, looks for DFU and DFD fields,
         which hold discharge range factor values for upstream and
         downstream direction
+    :param topo: topology of the stream network (tools.topology). Built
+        from the stream array if not provided
+    :param cache: optional dictionary of dam footprints from an earlier run.
+        Footprints found in the cache are reused, all others are calculated.
+        On return, the dictionary holds the footprints of exactly the given
+        dams (see footprint_key)
+    :param drf_sweep: optional list of discharge range factors, or of
+        (upstream, downstream) pairs of factors. If given, the DOF is
+        calculated for all factors at once and dof_field must be a list with
+        one field per factor. drf_upstream, drf_downstream,
+        use_dam_level_df and cache are then not used
     :return: stream array with updates DOF values
     """
 
-    ndoid = streams["NDOID"].tolist()
-    nuoid = streams["NUOID"].tolist()
-    wfall = streams["HYFALL"].tolist()
-    disch = streams["DIS_AV_CMS"].tolist()
+    # Fail early if the decay function is not defined
+    get_decay_function(mode)
+
+    net = DofNetwork(streams, topo)
+
+    if drf_sweep is not None:
+        if len(dof_field) != len(drf_sweep):
+            raise ValueError("{} DOF fields given for {} discharge range "
+                             "factors".format(len(dof_field), len(drf_sweep)))
 
-    upstream_mode = mode
-    downstream_mode = mode
+        dof_sweep = calculate_DOF_sweep(dams, net, mode, drf_sweep)
+        for k, field in enumerate(dof_field):
+            streams[field] = np.maximum(streams[field], dof_sweep[:, k])
+        return
 
-    nodes = []
-    downstream_reaches = set([])
-    stop = set([])
+    dof = streams[dof_field]
+
+    if cache is not None:
+        network_key = net.key()
+        footprints = {}
 
-    # First process everything upstream of dam
     for dam in dams:
 
-        dam_goid = dam[fd.GOID]
+        dam_oid = dam[fd.GOID] - 1
 
         if use_dam_level_df is True:
             drf_upstream = dam[fd.DFU]
@@ -64,157 +86,475 @@ def calculate_DOF(dams, streams, mode, dof_field, drf_upstream, drf_downstream,
                 print ("discharge range factor (downstream) can not be "
                        "lower than 1. Setting drf_downstream to 1")
 
-        nodes.append(dam_goid)  # Add the dam to the nodes list to process
-        stop.clear()
-        stop.add(dam_goid)
-        downstream_reaches.clear()
-
-        discharge_barrier_location = disch[dam_goid - 1]
-
-        if discharge_barrier_location == 0:
-            streams[dam_goid - 1][dof_field] = 100
-            continue
-
-        # discharge range factor, usually 10 (= one order of magnitude)
-        dis_low = discharge_barrier_location / drf_upstream
-        dis_hgh = discharge_barrier_location * drf_downstream
-
-        # 1) First process everything upstream of dam
-        while 1:
-            new_nodes = []
-            if len(nodes) == 0:
-                break
-            for n in nodes:
-
-                # Add one or several constraints on how to rout
-                if n <> -1 and n <> '':
-
-                    # Check if node has waterfall. If the waterfall is on the
-                    # reach where the dam is, stop routing upstream
-                    if wfall[n - 1] == 0:
-                        # Check for conditions of discharge
-                        if dis_hgh >= disch[n - 1] >= dis_low:
-                            # declare segment as fragmented
-                            discharge_local = disch[n - 1]
-
-                            local_impact_score = get_dof_up(
-                                discharge_local=discharge_local,
-                                discharge_barrier=discharge_barrier_location,
-                                upstream_mode=upstream_mode,
-                                dis_range_factor=drf_upstream)
-                            if streams[n - 1][
-                                dof_field] <= local_impact_score or \
-                                    streams[n - 1][dof_field] == 0:
-                                streams[n - 1][
-                                    dof_field] = local_impact_score
-
-                            # if local_impact_score > 0:  # find upstream nodes
-                            upstream_oid = nuoid[n - 1].split("_")
-                            if len(upstream_oid) > 0:
-                                for up in upstream_oid:
-                                    if up <> '' and up > 0:
-                                        new_nodes.append(int(up))
-
-            nodes = new_nodes
-
-        # 2) Then process downstream
-        nodes.append(dam_goid)  # Add the dam to the nodes list to process
-
-        while 1:
-            new_nodes = []
-            if len(nodes) == 0:
-                break
-            for n in nodes:
-                if n <> -1 and n <> '':
-                    # declare segment as fragmented if local discharge of
-                    # reach is within upper and lower limits
-                    discharge_local = disch[n - 1]
-                    if dis_low <= discharge_local <= dis_hgh:
-                        local_impact_score = get_dof_down(
-                            discharge_local=discharge_local,
-                            discharge_barrier=discharge_barrier_location,
-                            downstream_mode=downstream_mode,
-                            dis_range_factor=drf_downstream)
-                        if streams[n - 1][dof_field] <= local_impact_score or \
-                                streams[n - 1][dof_field] == 0:
-                            streams[n - 1][dof_field] = local_impact_score
-
-                        # if local_impact_score > 0:  # find downstream nodes
-                        downstream_oid = ndoid[n - 1]
-                        if downstream_oid > 0:
-                            new_nodes.append(int(downstream_oid))
-                            downstream_reaches.add(downstream_oid)
-
-            nodes = new_nodes
-
-
-def get_dof_down(discharge_local, discharge_barrier, downstream_mode,
-                 dis_range_factor):
-    """
-    Calculates DOF for downstream reaches
-
-    :param discharge_local: discharge (CMS) at current river reach to be processed
-    :param discharge_barrier: discharge (CMS) at river reach of barrier location
-    :param downstream_mode: defines the function of gradual decay of effect in the downstream
-    direction
+        if cache is None:
+            reached, local_impact_score = dam_footprint(
+                net, dam_oid, drf_upstream, drf_downstream, mode)
+        else:
+            key = footprint_key(net.goid[dam_oid], drf_upstream,
+                                drf_downstream, mode, network_key)
+            footprint = footprints.get(key, cache.get(key))
+            if footprint is None:
+                footprint = dam_footprint(net, dam_oid, drf_upstream,
+                                          drf_downstream, mode)
+            footprints[key] = footprint
+            reached, local_impact_score = footprint
+
+        dof[reached] = np.maximum(dof[reached], local_impact_score)
+
+    if cache is not None:
+        # Footprints of dams that are no longer in the list are dropped
+        cache.clear()
+        cache.update(footprints)
+
+
+def calculate_DOF_sweep(dams, net, mode, drf_sweep):
+    """
+    Calculates the DOF for a series of discharge range factors, e.g. for a
+    sensitivity analysis. The network is traversed once per dam with the
+    widest discharge window of the series, and the narrower windows are
+    then selected from the reaches found, see dam_footprint_sweep
+
+    :param dams: numpy array including one or several dams
+    :param net: stream network prepared with DofNetwork
+    :param mode: numeric value defining the selection of decay function
+    :param drf_sweep: list of discharge range factors, or of (upstream,
+        downstream) pairs of factors
+    :return: DOF values, array with one row per river reach and one column
+        per discharge range factor
+    """
+    factors = np.array(drf_sweep, dtype=np.float64)
+    if factors.ndim == 1:
+        factors = np.column_stack([factors, factors])
+
+    if factors.ndim != 2 or factors.shape[1] != 2:
+        raise ValueError("drf_sweep must hold discharge range factors or "
+                         "(upstream, downstream) pairs of factors")
+
+    if (factors < 1).any():
+        print ("discharge range factors can not be lower than 1. "
+               "Setting them to 1")
+
+    # To prevent log10(1) = 0, see calculate_DOF
+    factors[factors <= 1] = 1.000000000000001
+
+    dof = np.zeros((net.disch.shape[0], factors.shape[0]), dtype=np.float32)
+
+    for dam in dams:
+        dam_oid = dam[fd.GOID] - 1
+        reached, local_impact_score = dam_footprint_sweep(
+            net, dam_oid, factors[:, 0], factors[:, 1], mode)
+
+        dof[reached] = np.maximum(dof[reached], local_impact_score)
+
+    return dof
+
+
+class DofNetwork(object):
+    """
+    Stream network prepared for the DOF calculation of many dams: the
+    nested set index of the topology, the discharge and its log10, and the
+    reaches sorted by discharge
+    """
+
+    def __init__(self, streams, topo=None):
+        """
+        :param streams: numpy array with a stream network
+        :param topo: topology of the stream network (tools.topology). Built
+            from the stream array if not provided
+        """
+        if topo is None:
+            topo = topology.build_topology(streams)
+
+        self.pre, self.size, self.euler = topo.nested_set()
+        self.down = topo.down
+        self.down_list = topo.down.tolist()
+
+        self.goid = streams[fd.GOID]
+        self.wfall = streams[fd.HYFALL]
+        self.disch = streams[fd.DIS_AV_CMS]
+        self.disch_list = self.disch.tolist()
+
+        # The decay functions work on the log10 of the discharge. Reaches
+        # without discharge are never scored, their -inf is never used
+        with np.errstate(divide="ignore"):
+            self.log_disch = np.log10(self.disch)
+
+        # Reaches sorted by discharge. All reaches within the discharge
+        # window of a dam can then be found with two binary searches
+        self.dis_order = np.argsort(self.disch, kind="mergesort")
+        self.dis_sorted = self.disch[self.dis_order]
+
+    def key(self):
+        """
+        Hash of everything a DOF footprint depends on: the reach ids, the
+        routing, the discharge and the waterfalls
+        """
+        sha = hashlib.sha1()
+        for col in [self.goid, self.down, self.disch, self.wfall]:
+            sha.update(np.ascontiguousarray(col).tobytes())
+        return sha.hexdigest()
+
+
+def footprint_key(goid, drf_upstream, drf_downstream, mode, network_key):
+    """
+    Key of a dam footprint in the footprint cache. A footprint can be
+    reused as long as the dam location, its discharge range factors, the
+    decay function and the river network of the basin are the same.
+
+    :param goid: global id of the river reach of the dam
+    :param drf_upstream: discharge range factor upstream
+    :param drf_downstream: discharge range factor downstream
+    :param mode: DOF mode (decay function)
+    :param network_key: hash of the river network, see DofNetwork.key
+    :return: key
+    """
+    return (int(goid), float(drf_upstream), float(drf_downstream), mode,
+            network_key)
+
+
+def dam_footprint(net, dam_oid, drf_upstream, drf_downstream, mode):
+    """
+    Calculates the DOF footprint of a single dam, i.e. the river reaches it
+    affects and their DOF values
+
+    :param net: stream network prepared with DofNetwork
+    :param dam_oid: position of the dam reach in the stream array
+    :param drf_upstream: discharge range factor upstream (larger than 1)
+    :param drf_downstream: discharge range factor downstream (larger than 1)
+    :param mode: numeric value defining the selection of decay function
+    :return: positions of the affected reaches and their DOF values
+    """
+    discharge_barrier_location = net.disch_list[dam_oid]
+
+    if discharge_barrier_location == 0:
+        return (np.array([dam_oid], dtype=np.int64),
+                np.array([100], dtype=np.float32))
+
+    # discharge range factor, usually 10 (= one order of magnitude)
+    dis_low = discharge_barrier_location / drf_upstream
+    dis_hgh = discharge_barrier_location * drf_downstream
+
+    # 1) First process everything upstream of dam. The dam reach itself is
+    # scored with the downstream reaches
+    reached_up = upstream_reaches(dam_oid, dis_low, dis_hgh, net.pre,
+                                  net.size, net.euler, net.down, net.wfall,
+                                  net.disch, net.dis_order, net.dis_sorted)
+    reached_up = reached_up[reached_up != dam_oid]
+
+    score_up = get_dof_up_array(
+        log_discharge_local=net.log_disch[reached_up],
+        log_discharge_barrier=net.log_disch[dam_oid],
+        upstream_mode=mode,
+        dis_range_factor=drf_upstream)
+
+    # 2) Then process downstream
+    # declare segment as fragmented if local discharge of
+    # reach is within upper and lower limits
+    reached_down = []
+    n = dam_oid
+    while n != -1 and dis_low <= net.disch_list[n] <= dis_hgh:
+        reached_down.append(n)
+        n = net.down_list[n]
+
+    score_down = get_dof_down_array(
+        log_discharge_local=net.log_disch[reached_down],
+        log_discharge_barrier=net.log_disch[dam_oid],
+        downstream_mode=mode,
+        dis_range_factor=drf_downstream)
+
+    reached = np.concatenate([reached_up, reached_down]).astype(np.int64)
+    score = np.concatenate([score_up, score_down]).astype(np.float32)
+
+    return reached, score
+
+
+def dam_footprint_sweep(net, dam_oid, drf_upstream, drf_downstream, mode):
+    """
+    Calculates the DOF footprint of a single dam for a series of discharge
+    range factors at once.
+
+    The affected reaches are searched once with the widest discharge window.
+    A reach is also affected under a narrower window if the lowest and the
+    highest discharge on its way to the dam fall into that window. These two
+    path discharges are accumulated over the reaches found, and then tested
+    against each window.
+
+    :param net: stream network prepared with DofNetwork
+    :param dam_oid: position of the dam reach in the stream array
+    :param drf_upstream: array of discharge range factors upstream (larger
+        than 1)
+    :param drf_downstream: array of discharge range factors downstream
+        (larger than 1), same length as drf_upstream
+    :param mode: numeric value defining the selection of decay function
+    :return: positions of the affected reaches and their DOF values, with
+        one column per pair of discharge range factors
+    """
+    n_factors = drf_upstream.shape[0]
+    discharge_barrier_location = net.disch_list[dam_oid]
+
+    if discharge_barrier_location == 0:
+        return (np.array([dam_oid], dtype=np.int64),
+                np.full((1, n_factors), 100, dtype=np.float32))
+
+    dis_low = discharge_barrier_location / drf_upstream
+    dis_hgh = discharge_barrier_location * drf_downstream
+
+    # 1) Upstream of the dam, searched with the widest window
+    reached_up = upstream_reaches(dam_oid, dis_low.min(), dis_hgh.max(),
+                                  net.pre, net.size, net.euler, net.down,
+                                  net.wfall, net.disch, net.dis_order,
+                                  net.dis_sorted)
+    path_low, path_hgh = _path_discharge_range(reached_up, dam_oid, net)
+
+    keep = reached_up != dam_oid
+    reached_up = reached_up[keep]
+    path_low = path_low[keep]
+    path_hgh = path_hgh[keep]
+
+    # 2) Downstream of the dam, also with the widest window. The lowest and
+    # highest discharge from the dam down to each reach are running extremes
+    reached_down = []
+    n = dam_oid
+    low = dis_low.min()
+    hgh = dis_hgh.max()
+    while n != -1 and low <= net.disch_list[n] <= hgh:
+        reached_down.append(n)
+        n = net.down_list[n]
+
+    reached_down = np.array(reached_down, dtype=np.int64)
+    down_low = np.minimum.accumulate(net.disch[reached_down])
+    down_hgh = np.maximum.accumulate(net.disch[reached_down])
+
+    log_barrier = net.log_disch[dam_oid]
+    log_up = net.log_disch[reached_up]
+    log_down = net.log_disch[reached_down]
+
+    score_up = np.zeros((reached_up.shape[0], n_factors), dtype=np.float32)
+    score_down = np.zeros((reached_down.shape[0], n_factors),
+                          dtype=np.float32)
+
+    for k in range(n_factors):
+        inside = (path_low >= dis_low[k]) & (path_hgh <= dis_hgh[k])
+        score_up[inside, k] = get_dof_up_array(
+            log_discharge_local=log_up[inside],
+            log_discharge_barrier=log_barrier,
+            upstream_mode=mode,
+            dis_range_factor=drf_upstream[k])
+
+        inside = (down_low >= dis_low[k]) & (down_hgh <= dis_hgh[k])
+        score_down[inside, k] = get_dof_down_array(
+            log_discharge_local=log_down[inside],
+            log_discharge_barrier=log_barrier,
+            downstream_mode=mode,
+            dis_range_factor=drf_downstream[k])
+
+    reached = np.concatenate([reached_up, reached_down])
+    score = np.concatenate([score_up, score_down])
+
+    return reached, score
+
+
+def _path_discharge_range(reached, dam_oid, net):
+    """
+    Lowest and highest discharge on the way from each reach down to the
+    dam, both ends included. The reached reaches form a tree below the dam,
+    so the extremes can be accumulated by pointer jumping.
+    """
+    low = net.disch[reached]
+    hgh = low.copy()
+
+    if reached.shape[0] == 0:
+        return low, hgh
+
+    # Local position of the downstream reach of each reached reach, -1 for
+    # the dam
+    srt = np.argsort(reached)
+    local = np.searchsorted(reached[srt], net.down[reached])
+    local = srt[np.minimum(local, reached.shape[0] - 1)]
+    nxt = np.where(reached == dam_oid, -1, local)
+
+    active = np.flatnonzero(nxt >= 0)
+    while active.size > 0:
+        low[active] = np.minimum(low[active], low[nxt[active]])
+        hgh[active] = np.maximum(hgh[active], hgh[nxt[active]])
+        nxt[active] = nxt[nxt[active]]
+        active = active[nxt[active] >= 0]
+
+    return low, hgh
+
+
+def upstream_reaches(dam_oid, dis_low, dis_hgh, pre, size, euler, down, wfall,
+                     disch, dis_order, dis_sorted):
+    """
+    Finds the river reaches upstream of a dam that are affected by it.
+
+    A reach is affected if it, and every reach between it and the dam, has
+    no waterfall and a discharge between dis_low and dis_hgh. Instead of
+    walking upstream reach by reach, the candidates are taken from the
+    nested set range of the dam (see tools.topology) or from the reaches
+    sorted by discharge, whichever is smaller. Candidates that hang below a
+    reach that fails the test are then removed by their nested set ranges.
+
+    :param dam_oid: position of the dam reach in the stream array
+    :param dis_low: lower limit of the discharge window
+    :param dis_hgh: upper limit of the discharge window
+    :param pre: nested set pre-order numbers
+    :param size: nested set range sizes
+    :param euler: reach positions in nested set pre-order
+    :param down: position of the next downstream reach
+    :param wfall: waterfall (1) or not (0)
+    :param disch: discharge of each reach
+    :param dis_order: reach positions sorted by discharge
+    :param dis_sorted: discharges sorted in ascending order
+    :return: positions of the affected reaches, including the dam reach
+    """
+
+    # If the waterfall is on the reach where the dam is, stop routing upstream
+    if wfall[dam_oid] != 0:
+        return np.zeros(0, dtype=np.int64)
+
+    start = pre[dam_oid]
+    stop = start + size[dam_oid]
+
+    lo = np.searchsorted(dis_sorted, dis_low, side="left")
+    hi = np.searchsorted(dis_sorted, dis_hgh, side="right")
+
+    if stop - start <= hi - lo:
+        cand = euler[start:stop]
+        dis = disch[cand]
+        cand = cand[(dis >= dis_low) & (dis <= dis_hgh)]
+    else:
+        cand = dis_order[lo:hi]
+        p = pre[cand]
+        cand = cand[(p >= start) & (p < stop)]
+
+    cand = cand[wfall[cand] == 0]
+
+    # Candidates whose downstream reach fails the test are cut off from the
+    # dam, and so is everything upstream of them
+    above = cand[cand != dam_oid]
+    dw = down[above]
+    dis = disch[dw]
+    passes = (wfall[dw] == 0) & (dis >= dis_low) & (dis <= dis_hgh)
+    cut = above[~passes]
+
+    if cut.size > 0:
+        cut_start = pre[cut]
+        srt = np.argsort(cut_start)
+        cut_start = cut_start[srt]
+        # The ranges are nested or disjoint, so a reach is cut off if the
+        # furthest reaching range that starts before it still covers it
+        cut_stop = np.maximum.accumulate((pre[cut] + size[cut])[srt])
+
+        p = pre[cand]
+        k = np.searchsorted(cut_start, p, side="right") - 1
+        covered = (k >= 0) & (p < cut_stop[np.maximum(k, 0)])
+        cand = cand[~covered]
+
+    return cand
+
+
+def get_dof_down_array(log_discharge_local, log_discharge_barrier,
+                       downstream_mode, dis_range_factor):
+    """
+    Calculates DOF for a batch of downstream reaches, from arrays of log10
+    discharges
+
+    :param log_discharge_local: log10 of discharge (CMS) at the reaches to be
+    processed
+    :param log_discharge_barrier: log10 of discharge (CMS) at river reach of
+    barrier location
+    :param downstream_mode: defines the function of gradual decay of effect in
+    the downstream direction
     :param dis_range_factor: defines the ratio between discharge_barrier and
     discharge_local below which DOF effects are considered
-    :return: degree of fragmentation (DOF) in percent
-    """
-    if discharge_local < discharge_barrier:
-        # prevents DOF to become larger than 100
-        # in special cases when e.g, discharge decreases downstream
-        # and becomes larger than local discharge
-        discharge_local = discharge_barrier  # reset discharge
-
-    if downstream_mode == 1:  # log two order
-        a = abs(math.log10(discharge_local) - math.log10(discharge_barrier))
-        b = a * (100 / math.log10(dis_range_factor))
-        x = 100 - b
-    else:
-        print "discharge mode undefined"
-        sys.exit()
+    :return: degree of fragmentation (DOF) in percent for each reach
+    """
+    decay = get_decay_function(downstream_mode)
 
-    # I some cases x can get out of bounds
-    if x < 0:
-        x = 0
-    if x > 100:
-        x = 100
+    # prevents DOF to become larger than 100
+    # in special cases when e.g, discharge decreases downstream
+    # and becomes larger than local discharge
+    log_discharge_local = np.maximum(log_discharge_local,
+                                     log_discharge_barrier)
 
-    return x
+    x = decay(log_discharge_local, log_discharge_barrier,
+              math.log10(dis_range_factor))
 
+    return np.clip(x, 0, 100)
 
-def get_dof_up(discharge_local, discharge_barrier, upstream_mode,
-               dis_range_factor):
-    """
-    Calculates DOF for upstream reaches
 
-    :param discharge_local: discharge (CMS) at current river reach to be processed
-    :param discharge_barrier: discharge (CMS) at river reach of barrier location
-    :param upstream_mode: defines the function of gradual decay of effect in the upstream direction
+def get_dof_up_array(log_discharge_local, log_discharge_barrier,
+                     upstream_mode, dis_range_factor):
+    """
+    Calculates DOF for a batch of upstream reaches, from arrays of log10
+    discharges
+
+    :param log_discharge_local: log10 of discharge (CMS) at the reaches to be
+    processed
+    :param log_discharge_barrier: log10 of discharge (CMS) at river reach of
+    barrier location
+    :param upstream_mode: defines the function of gradual decay of effect in
+    the upstream direction
     :param dis_range_factor: defines the ratio between discharge_barrier and
     discharge_local below which DOF effects are considered
-    :return: degree of fragmentation (DOF) in percent
+    :return: degree of fragmentation (DOF) in percent for each reach
     """
+    decay = get_decay_function(upstream_mode)
 
-    if discharge_local > discharge_barrier:
-        discharge_local = discharge_barrier
-        # prevents DOF to become larger than 100
-        # in special cases when e.g, discharge increases upstream,
-        # and becomes smaller than local discharge
+    # prevents DOF to become larger than 100
+    # in special cases when e.g, discharge increases upstream,
+    # and becomes smaller than local discharge
+    log_discharge_local = np.minimum(log_discharge_local,
+                                     log_discharge_barrier)
 
-    if upstream_mode == 1:  # log one order
-        a = abs(math.log10(discharge_local) - math.log10(discharge_barrier))
-        b = a * (100 / math.log10(dis_range_factor))
-        x = 100 - b
-    else:
-        print "discharge mode undefined"
-        sys.exit()
+    x = decay(log_discharge_local, log_discharge_barrier,
+              math.log10(dis_range_factor))
+
+    return np.clip(x, 0, 100)
+
+
+def decay_log(log_discharge_local, log_discharge_barrier, log_range_factor):
+    """
+    Decay function of mode 1. The DOF decreases linearly with the
+    difference in log10 discharge, from 100 at the barrier to 0 at the edge
+    of the discharge range
+
+    :param log_discharge_local: log10 of the local discharge (scalar or array)
+    :param log_discharge_barrier: log10 of the discharge at the barrier
+    :param log_range_factor: log10 of the discharge range factor
+    :return: degree of fragmentation (DOF) in percent, not yet clipped
+    """
+    a = np.abs(log_discharge_local - log_discharge_barrier)
+    b = a * (100 / log_range_factor)
+    return 100 - b
+
+
+# Decay functions by DOF mode (parameter dof_mode). A decay function takes the
+# log10 of the local discharge, of the discharge at the barrier and of the
+# discharge range factor, and must accept scalars as well as arrays for the
+# local discharge. Further modes are added with register_decay_function
+DECAY_FUNCTIONS = {1: decay_log}
 
-    # I some cases x can get out of bounds
-    if x < 0:
-        x = 0
-    if x > 100:
-        x = 100
 
-    return x
+def register_decay_function(mode, decay):
+    """
+    Adds a decay function for a DOF mode
+
+    :param mode: numeric value of the mode, as used in the parameter dof_mode
+    :param decay: decay function, see decay_log
+    """
+    DECAY_FUNCTIONS[mode] = decay
+
+
+def get_decay_function(mode):
+    """
+    Returns the decay function of a DOF mode
+
+    :param mode: numeric value defining the selection of decay function
+    :return: decay function
+    """
+    try:
+        return DECAY_FUNCTIONS[mode]
+    except KeyError:
+        raise ValueError("discharge mode {} undefined".format(mode))
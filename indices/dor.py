@@ -1,9 +1,10 @@
+import tools.topology as topology
 from config import config
 
 fd = config.var
 
 
-def calculate_dor(dams, streams, dor_field):  # List of OIDs
+def calculate_dor(dams, streams, dor_field, topo=None):  # List of OIDs
     """
     Updates the degree of regulation (DOR) index, given a
     set of dams.
@@ -11,11 +12,16 @@ def calculate_dor(dams, streams, dor_field):  # List of OIDs
     :param dams: numpy array of barriers and their attributes
     :param streams: numpy array of streams and their attributes
     :param dor_field: field to store the DOR values
+    :param topo: topology of the stream network (tools.topology). Built
+        from the stream array if not provided
     :return: stream array with updated DOR values
     """
 
+    if topo is None:
+        topo = topology.build_topology(streams)
+
     length = streams.shape[0]
-    ndoid = streams["NDOID"].tolist()
+    down = topo.down.tolist()
     disch = streams["DIS_AV_CMS"].tolist()
     svol = [0] * length
 
@@ -38,9 +44,9 @@ def calculate_dor(dams, streams, dor_field):  # List of OIDs
                 new_dor = get_dor(disch[dam_oid - 1], svol[dam_oid - 1])
                 streams[dam_oid - 1][dor_field] = new_dor
 
-                dw = ndoid[dam_oid - 1]
-                if dw != 0:
-                    new_node = dw
+                dw = down[dam_oid - 1]
+                if dw != -1:
+                    new_node = dw + 1
 
             dam_oid = new_node
 
@@ -1,16 +1,23 @@
-import math
 import logging
+
+import numpy as np
+
 import config.config
+import tools.topology as topology
 
 fd = config.config.var
 
 
-def lakes_calculate(lakes):
+def lakes_calculate(lakes, n):
     """
     Calculate the trapping of sediments in natural lakes
 
-    :param lakes: numpy array with properties of lakes
-    :return: dictionaries of small and large lakes and their trapping in tons per year
+    :param lakes: numpy array with properties of lakes. The field GOID holds
+        the network id (NOID) of the reach of each lake
+    :param n: number of reaches in the stream network
+    :return: arrays with one value per reach (at position NOID - 1): the
+        trapping of small lakes in tons per year, and the volume of large
+        lakes
     """
     prt("")
     prt("***************************************************")
@@ -26,216 +33,217 @@ def lakes_calculate(lakes):
     # (some lakes are outside , coastal etc.)
     lakes = arr2[arr2["IN_CATCH"] == 1]
 
-    # Dictionaries will hold values
-    small_lake_loss_dict = {}
-    large_lake_volu_dict = {}
-
-    # Iterate through the lakes and extract values, fill dictionaries etc.
-    for lake in lakes:
-        goid = lake["GOID"]
+    # Lakes not in stream network: calculate TE_brune and loss, all at once
+    out_net = lakes["IN_STREAM"] == 0
+    lakes["TE_brune"][out_net] = TE(lakes["Vol_total"][out_net],
+                                    lakes["Dis_avg"][out_net])
+    lakes["LOSS_LKES_OUT_NET"][out_net] = \
+        lakes["TE_brune"][out_net] * lakes["SED_ACC"][out_net]
 
-        if lake["IN_STREAM"] == 0:
-            # not in stream network, calculate TE_brune and loss
-            lake_te = TE(lake["Vol_total"], lake["Dis_avg"])
-            lake["TE_brune"] = lake_te
+    # Sum the losses of the small lakes, and the volume of the large lakes
+    # for later processing during routing, for each reach
+    small_lake_loss = sum_per_reach(lakes["GOID"][out_net],
+                                    lakes["LOSS_LKES_OUT_NET"][out_net], n)
+    large_lake_volu = sum_per_reach(lakes["GOID"][~out_net],
+                                    lakes["Vol_total"][~out_net], n)
 
-            lake["LOSS_LKES_OUT_NET"] = lake["TE_brune"] * lake["SED_ACC"]
+    return small_lake_loss, large_lake_volu
 
-            curr_loss = small_lake_loss_dict.get(goid, 0)
-            small_lake_loss_dict[goid] = curr_loss + lake["LOSS_LKES_OUT_NET"]
 
-        else:
-            # sum volume_mcm for later processing during routing
-            current_lake = large_lake_volu_dict.get(goid, 0)
-            large_lake_volu_dict[goid] = current_lake + lake["Vol_total"]
-
-    return small_lake_loss_dict, large_lake_volu_dict
+def sum_per_reach(noids, values, n):
+    """
+    Sums values, for example of several lakes or dams on the same river
+    reach, for each reach
+
+    :param noids: network id (NOID) of each value. Values with a NOID that
+        is not in the network (e.g. 0) are ignored
+    :param values: values to sum
+    :param n: number of reaches in the stream network
+    :return: array with the sum of each reach, at position NOID - 1
+    """
+    valid = (noids >= 1) & (noids <= n)
+    return np.bincount(noids[valid].astype(np.int64) - 1,
+                       weights=values[valid].astype(np.float64), minlength=n)
 
 
-def calculate_sed(streams, dam_volu_dict, lake_volu_dict, small_lake_loss_dict):
+def calculate_sed(streams, dam_volu, lake_volu, small_lake_loss, topo=None):
     """
     Calculates the Sediment Trapping Index (SED)
 
-    :param streams:
-    :param dam_volu_dict:
-    :param lake_volu_dict:
-    :param small_lake_loss_dict:
+    The fields are copied into plain arrays, and the reaches are processed
+    one generation at a time (see tools.topology.Topology.levels). All
+    reaches of a generation are calculated at once, and their sediment
+    loads are added to their downstream reaches with np.bincount. The
+    natural and the anthropogenic loads are routed in the same traversal.
+    The stream array can hold the whole network or one river basin, see
+    scripts.ffr_run_sed.run_basin
+
+    :param streams: stream array whose routing index has been updated
+    :param dam_volu: volume of the dams of each reach, see sum_per_reach
+    :param lake_volu: volume of the large lakes of each reach, see
+        lakes_calculate
+    :param small_lake_loss: trapping of the small lakes of each reach, see
+        lakes_calculate
+    :param topo: topology of the stream network (tools.topology). Built
+        from the stream array if not provided
     :return:
     """
 
-    # 1) Accumulate sediments taking into account lakes inside and outside
-    # the network
-    #
-    # Calculating potential sediment load
-
-    prt("")
-    prt("***************************************************")
-    prt("PART 2: Calculating potential sediment load")
-    prt("***************************************************")
-    prt("")
-
-    for stream in streams:
-
-        dis = stream[fd.DIS_AV_CMS]
-        noid = stream[fd.NOID]
-
-        vol_lakes_in_network = lake_volu_dict.get(noid, 0)
-
-        loss_lakes_outside_net = small_lake_loss_dict.get(noid, 0)
-
-        sed_sum_current = stream[fd.ERO_YLD_TON]
-        sed_nat_ups = stream[fd.SED_NAT_UP]
-
-        sed_nat = sed_sum_current + sed_nat_ups
-
-        # 1) Account for losses from natural lakes outside network (Type 1)
-        sed_nat = sed_nat - loss_lakes_outside_net
-
-        # Write into table
-        stream[fd.SED_LSS_LKS_OT_NAT] = loss_lakes_outside_net
-
-        # 2) Account for losses from natural lakes inside network (Type 1)
-        loss_lakes_in_nat = sed_nat - (
-                sed_nat * TE(vol_lakes_in_network, dis))
-
-        # Write into table
-        stream[fd.SED_LSS_LKS_IN_NAT] = loss_lakes_in_nat
+    if topo is None:
+        topo = topology.build_topology(streams)
 
-        sed_nat = sed_nat - loss_lakes_in_nat
+    n = streams.shape[0]
+    down = topo.down
 
-        # 3) Write to table
-        stream[fd.SED_NAT] = sed_nat
+    dis = streams[fd.DIS_AV_CMS].astype(np.float64)
+    ero = streams[fd.ERO_YLD_TON].astype(np.float64)
 
-        # Add the results to next downstream reach
-        if streams[stream[fd.NOID] - 1][fd.NDOID] <> 0:
-            streams[stream[fd.NDOID] - 1][fd.SED_NAT_UP] = \
-                streams[stream[fd.NDOID] - 1][fd.SED_NAT_UP] + sed_nat
-
-    # 2) Accumulate sediments taking into account lakes inside and
-    # outside the network and dams
+    # Volumes and losses of each reach
+    vol_lakes = np.asarray(lake_volu, dtype=np.float64)
+    vol_dams = np.asarray(dam_volu, dtype=np.float64)
+    loss_out = np.asarray(small_lake_loss, dtype=np.float64)
 
-    # Calculating anthropogenic sediment load
+    # The natural (1) and the anthropogenic (2) sediment loads are routed in
+    # the same traversal of the network, and the index (3) of a reach is
+    # calculated as soon as both loads are known
 
-    prt("")
-    prt("***************************************************")
-    prt("PART 3: Calculating anthropogenic sediment load    ")
-    prt("***************************************************")
-    prt("")
+    sed_nat_up = streams[fd.SED_NAT_UP].astype(np.float64)
+    sed_ant_up = streams[fd.SED_ANT_UP].astype(np.float64)
 
-    for stream in streams:
+    loss_in_nat = np.zeros(n)
+    sed_nat = np.zeros(n)
+    loss_in_ant = np.zeros(n)
+    loss_dams_ant = np.zeros(n)
+    sed_ant = np.zeros(n)
+    sediment_loss = np.zeros(n)
+    sti = np.zeros(n)
 
-        dis = stream[fd.DIS_AV_CMS]
-        noid = stream[fd.NOID]
+    for level in topo.levels():
 
-        vol_lakes_in_network = lake_volu_dict.get(noid, 0)
-        vol_dams = dam_volu_dict.get(noid, 0)
+        te_lakes = TE(vol_lakes[level], dis[level])
+        te_dams = TE(vol_dams[level], dis[level])
 
-        loss_lakes_outside_net = small_lake_loss_dict.get(noid, 0)
+        # 1) Accumulate sediments taking into account lakes inside and
+        # outside the network (potential sediment load)
 
-        sed_sum_current = stream[fd.ERO_YLD_TON]
-        sed_ant_ups = stream[fd.SED_ANT_UP]
+        # Account for losses from natural lakes outside network (Type 1)
+        nat = ero[level] + sed_nat_up[level] - loss_out[level]
 
-        sed_ant = sed_sum_current + sed_ant_ups
+        # Account for losses from natural lakes inside network (Type 1)
+        loss = nat - (nat * te_lakes)
+        loss_in_nat[level] = loss
 
-        # 1) Account for losses from natural lakes outside network (Type 1)
-        sed_ant = sed_ant - loss_lakes_outside_net
+        nat = nat - loss
+        sed_nat[level] = nat
 
-        # Write into table
-        stream[fd.SED_LSS_LKS_OT_ANT] = loss_lakes_outside_net
+        # 2) Accumulate sediments taking into account lakes inside and
+        # outside the network and dams (anthropogenic sediment load)
 
-        # 2) Account for losses from natural lakes inside network
-        # (Type 1) and dams
+        # Account for losses from natural lakes outside network (Type 1)
+        ant = ero[level] + sed_ant_up[level] - loss_out[level]
 
         # First process the lakes, ....
-        loss_lakes_in_ant = sed_ant - (
-                sed_ant * TE(vol_lakes_in_network, dis))
+        loss = ant - (ant * te_lakes)
+        loss_in_ant[level] = loss
         # ... and substract the losses from lakes, ....
-        sed_ant = sed_ant - loss_lakes_in_ant
+        ant = ant - loss
         # then process the dams.....
-        loss_dams_in_ant = sed_ant - (
-                sed_ant * TE(vol_dams, dis))
+        loss = ant - (ant * te_dams)
+        loss_dams_ant[level] = loss
         # ... and substract the losses from dams
-        sed_ant = sed_ant - loss_dams_in_ant
-
-        # Write into table
-        stream[fd.SED_LSS_LKS_IN_ANT] = loss_lakes_in_ant
-
-        # Write into table
-        stream[fd.SED_LSS_DMS_ANT] = loss_dams_in_ant
-
-        # 3) Write to table
-        stream[fd.SED_ANT] = sed_ant
+        ant = ant - loss
+        sed_ant[level] = ant
 
         # Add the results to next downstream reach
-        if streams[stream[fd.NOID] - 1][fd.NDOID] <> 0:
-            streams[stream[fd.NDOID] - 1][fd.SED_ANT_UP] = \
-                streams[stream[fd.NDOID] - 1][fd.SED_ANT_UP] + sed_ant
+        _add_downstream(down[level], [sed_nat_up, sed_ant_up], [nat, ant])
 
-    # 3) Calculate the difference between 3 and 2, which is the
-    # losses due to dams
-    #
-    # Calculate index (difference)
+        # 3) Calculate the difference between 2 and 1, which is the
+        # losses due to dams
+        loss = nat - ant
+        sediment_loss[level] = loss
 
-    prt("")
-    prt("***************************************************")
-    prt("PART 4: Calculating SED index")
-    prt("***************************************************")
-    prt("")
+        # Make sure there is no division by zero error
+        valid = nat > 0.000000001
+        index = np.zeros(level.shape[0])
+        index[valid] = 100 * (loss[valid] / nat[valid])
 
-    for stream in streams:
-        sed_nat = stream[fd.SED_NAT]
-        sed_ant = stream[fd.SED_ANT]
+        # Clip values smaller than 0.1 just like for DOR
+        index[~(index >= 0.1)] = 0
+        sti[level] = index
 
-        sediment_loss = sed_nat - sed_ant
+    # Write into table
+    streams[fd.SED_LSS_LKS_OT_NAT] = loss_out
+    streams[fd.SED_LSS_LKS_IN_NAT] = loss_in_nat
+    streams[fd.SED_NAT_UP] = sed_nat_up
+    streams[fd.SED_NAT] = sed_nat
 
-        stream[fd.SED_LSS_TOT] = sediment_loss
+    streams[fd.SED_LSS_LKS_OT_ANT] = loss_out
+    streams[fd.SED_LSS_LKS_IN_ANT] = loss_in_ant
+    streams[fd.SED_LSS_DMS_ANT] = loss_dams_ant
+    streams[fd.SED_ANT_UP] = sed_ant_up
+    streams[fd.SED_ANT] = sed_ant
 
-        # Make sure there is no division by zero error
-        if sed_nat > 0.000000001:
+    streams[fd.SED_LSS_TOT] = sediment_loss
+    streams[fd.SED] = sti
 
-            sti = 100 * (sediment_loss / sed_nat)
+    return streams
 
-            # Clip values smaller than 0.1 just like for DOR
-            if sti >= 0.1:
-                stream[fd.SED] = 100 * (sediment_loss / sed_nat)
-            else:
-                stream[fd.SED] = 0
-        else:
-            stream[fd.SED] = 0
 
-    return streams
+def _add_downstream(down, accs, values):
+    """
+    Adds the values of a generation of reaches to their downstream reaches
+
+    :param down: downstream reach of each reach of the generation, -1 for
+        outlets
+    :param accs: list of arrays with the accumulated values of all
+        reaches, updated in place
+    :param values: list of arrays with the values of the reaches of the
+        generation, one for each array in accs
+    """
+    has_down = down >= 0
+    if has_down.any():
+        dw, inv = np.unique(down[has_down], return_inverse=True)
+        for acc, val in zip(accs, values):
+            acc[dw] += np.bincount(inv, weights=val[has_down])
 
 
 def TE(volume, discharge):
     """
     Calculates the trapping efficiency of reservoir or lake according to the Brune equation
 
+    Works on single values as well as on arrays of volumes and discharges,
+    which are calculated at once
+
     :param volume: volume of reservoir or lake in million cubic meters (MCM)
     :param discharge: discharge at reservoir or lake location (outflow) in cubic meters per
     second (CMS)
 
     :return: trapping efficiency in percent
     """
+    scalar = np.isscalar(volume) and np.isscalar(discharge)
+
+    volume, discharge = np.broadcast_arrays(
+        np.atleast_1d(np.asarray(volume, dtype=np.float64)),
+        np.atleast_1d(np.asarray(discharge, dtype=np.float64)))
 
-    if discharge < 0.00000001:
-        TE_RATIO = 1.0
-    else:
-        vol_dis = (volume * 1000000.0) / (
-                discharge * 60.0 * 60.0 * 24.0 * 365.0)
-        div = math.sqrt(vol_dis)
+    # No discharge: everything is trapped
+    te_ratio = np.ones(volume.shape)
 
-        if div < 0.00000001:
-            TEF = 0
-            TE_RATIO = 1.0 - TEF
-        else:
-            TEF = 1.0 - ((0.05) / float(div))
+    flow = discharge >= 0.00000001
+    vol_dis = (volume[flow] * 1000000.0) / (
+            discharge[flow] * 60.0 * 60.0 * 24.0 * 365.0)
+    div = np.sqrt(vol_dis)
 
-            if TEF < 0:
-                TEF = 0
+    tef = np.zeros(div.shape)
+    large = div >= 0.00000001
+    tef[large] = 1.0 - ((0.05) / div[large])
+    tef[tef < 0] = 0
 
-            TE_RATIO = 1.0 - TEF
+    te_ratio[flow] = 1.0 - tef
 
-    return TE_RATIO
+    if scalar:
+        return float(te_ratio[0])
+    return te_ratio
 
 
 def prt(txt):
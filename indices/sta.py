@@ -7,6 +7,7 @@ This includes calculating the
 import numpy as np
 import pandas as pd
 
+import tools.topology as topology
 from config import config as conf
 
 fd = conf.var
@@ -135,7 +136,7 @@ def return_sta(status_val, pct_ff_val):
         return 3
 
 
-def dissolve_rivers(stream_array_temp, ff_fields, dis_id_field):
+def dissolve_rivers(stream_array_temp, ff_fields, dis_id_field, topo=None):
     """
     This function is dissolving the results feature class and return
     aggregated results for each backbone river.
@@ -146,9 +147,14 @@ def dissolve_rivers(stream_array_temp, ff_fields, dis_id_field):
             the csi threshold
     :param dis_id_field: Returns dissolved and aggregated FC with statistics to feed
             into filtering (next step)
+    :param topo: topology of the stream network (tools.topology). Built
+            from the stream array if not provided
     :return:
     """
 
+    if topo is None:
+        topo = topology.build_topology(stream_array_temp)
+
     stream_array_temp[dis_id_field] = 0
 
     diss_field1 = str(fd.BB_ID)
@@ -159,7 +165,8 @@ def dissolve_rivers(stream_array_temp, ff_fields, dis_id_field):
 
     dissid = stream_array_temp[dis_id_field].tolist()
 
-    upsids = stream_array_temp["NUOID"].tolist()
+    up_ptr = topo.up_ptr.tolist()
+    up_idx = topo.up_idx.tolist()
 
     nodes = []
     diss_id_reach = 0
@@ -167,8 +174,7 @@ def dissolve_rivers(stream_array_temp, ff_fields, dis_id_field):
     # We need a set to check which ids are already in use. IDs should be unique
     diss_id_set = set([])
 
-    sink_streams = stream_array_temp[stream_array_temp["NDOID"] == 0]
-    sink_streams = sink_streams["NOID"].tolist()
+    sink_streams = (topo.outlets() + 1).tolist()
 
     x = 0
     for sink in sink_streams:
@@ -198,26 +204,19 @@ def dissolve_rivers(stream_array_temp, ff_fields, dis_id_field):
 
                     diss_id = dissid[node - 1]
 
-                    ups = upsids[node - 1].split("_")
-
-                    if len(ups) >= 1:
-                        for up in ups:
-                            if up != '':
-                                new_nodes.append(int(up))
-                                # Convert to int and adjust for index start at
-                                # 0
-                                up = int(up) - 1
-                                if (diss1[up] == diss_value1) & (
-                                        diss2[up] == diss_value2):
-                                    dissid[up] = diss_id
-                                else:
-                                    while True:
-                                        new_id = diss_id_reach + 1
-                                        if new_id not in diss_id_set:
-                                            diss_id_set.add(new_id)
-                                            break
-                                    dissid[up] = new_id
-                                    diss_id_reach = new_id
+                    for up in up_idx[up_ptr[node - 1]:up_ptr[node]]:
+                        new_nodes.append(up + 1)
+                        if (diss1[up] == diss_value1) & (
+                                diss2[up] == diss_value2):
+                            dissid[up] = diss_id
+                        else:
+                            while True:
+                                new_id = diss_id_reach + 1
+                                if new_id not in diss_id_set:
+                                    diss_id_set.add(new_id)
+                                    break
+                            dissid[up] = new_id
+                            diss_id_reach = new_id
             nodes = new_nodes
 
     # Assign list to numpy array field
@@ -14,6 +14,8 @@ import stats.global_stats as sts
 import stats.sensitivity as sns
 
 import tools.helper as tools
+import tools.network as network
+import tools.topology as topology
 
 # Creates an global object from the config class var. This holds the
 # field and path names names. For example ffd.RIV_ORD returns the name of
@@ -23,7 +25,7 @@ from config import config
 fd = config.var
 
 
-def run_csi(stamp, para, scenarios, st_flds, paths):
+def run_csi(stamp, para, scenarios, st_flds, paths, session=None):
     """
     This is the main function to calculate the Connectivity Status Index (CSI); to calculate the river
     status, and to post-process the results into tables.
@@ -46,10 +48,52 @@ def run_csi(stamp, para, scenarios, st_flds, paths):
     :param scenarios: Scenario set
     :param st_flds: list of fields
     :param paths: path settings
+    :param session: optional tools.session.Session of the model run, with
+        the results of the earlier stages
     :return:
 
     """
 
+    # Folder of the compiled stream network, empty to read the feature class
+    network_folder = tools.get_para(para, "network_folder", "")
+
+    # Otherwise, the stream fields can be cached between runs. The cache is
+    # off by default: a run of fra_start writes its results into the stream
+    # feature class (see Session.flush), which changes its signature, so the
+    # next run would never find its bundle in the cache
+    cache_folder = tools.get_para(para, "stream_cache_folder",
+                                  os.path.join(para["output_folder"],
+                                               "stream_cache"))
+    cache_size = int(tools.get_para(para, "stream_cache_size", 0))
+    if cache_size == 0:
+        cache_folder = ""
+
+    # A cached stream network is a network bundle like network_folder, with
+    # the topology of the whole network saved along with the fields
+    if not network_folder and cache_folder:
+        print ("Loading stream array from cache")
+        network_folder = network.cache_entry(cache_folder, para["streams_fc"],
+                                             cache_size)
+
+    # The stream network and its topology are loaded once and shared by all
+    # scenarios. Each scenario works on its own copy with added result
+    # fields, see below, and the base array is never changed
+    if network_folder:
+        stream_array = network.load_fields(para["streams_fc"], st_flds,
+                                           network_folder)
+        tools.update_stream_routing_index(stream_array)
+        topo = network.load_topology(para["streams_fc"], network_folder)
+    else:
+        stream_array = tools.load_stream_array(
+            stream_feature_class=para["streams_fc"],
+            stream_fields=st_flds)
+        topo = topology.build_topology(stream_array)
+
+    # Results of the earlier stages that were not written into the stream
+    # feature class
+    if session is not None:
+        session.apply(stream_array)
+
     # Looping through the individual scenarios
     for scenario in scenarios:
 
@@ -74,10 +118,6 @@ def run_csi(stamp, para, scenarios, st_flds, paths):
         # Define output CSI fc
         csi_fc_name = "csi_fc_" + str(sce_name)
 
-        stream_array = tools.load_stream_array(
-            stream_feature_class=para["streams_fc"],
-            stream_fields=st_flds)
-
         # Adding results fields to output table
 
         # Get the names of new csi fields to append
@@ -177,7 +217,7 @@ def run_csi(stamp, para, scenarios, st_flds, paths):
         # Dissolve
         prt("Dissolving part 1 of %s: " % ff_field_name)
         stream_alt = sta.dissolve_rivers(stream_alt, ff_field_name,
-                                         ffr_dis_field)
+                                         ffr_dis_field, topo)
 
         # The spatial dissolving identifies river stretches that were both small and had a
         # disproportionally high impact on the CSI. This function conducts a spatial selected
@@ -195,7 +235,7 @@ def run_csi(stamp, para, scenarios, st_flds, paths):
         # Dissolve again
         prt("Dissolving part 2 of %s: " % ff_field_name)
         stream_alt = sta.dissolve_rivers(stream_alt, ff_field_name,
-                                         ffr_dis_field)
+                                         ffr_dis_field, topo)
 
         prt("Updating array %s: " % ff_field_name)
         stream_csi = sta.update_streams_with_diss_id(
@@ -248,6 +288,11 @@ def run_csi(stamp, para, scenarios, st_flds, paths):
         if to_export == 1:
             csi_table = str(csi_tb) + str(sce_name)
 
+            # The exported feature class is joined to the stream feature
+            # class, which must hold the results of the earlier stages
+            if session is not None:
+                session.flush()
+
             # Reduce numpy array to only necessary fields, i.e
             # get the names of new csi fields to append to input streams
             # feature class
@@ -277,7 +322,6 @@ def run_csi(stamp, para, scenarios, st_flds, paths):
             prt("Deleting join fields")
             tools.delete_field(output_fc, ["OBJECTID_1", "GOID_1"])
 
-        stream_array = None
         stream_csi = None
 
     prt("")
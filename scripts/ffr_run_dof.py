@@ -6,16 +6,18 @@ import time
 
 import arcpy
 import numpy as np
-import pandas as pd
 
 import indices.dof
 import tools.helper as tool
+import tools.network as network
+import tools.parallel as parallel
+import tools.topology as topology
 from config import config
 
 fd = config.var
 
 
-def run_dof(stamp, para, paths):
+def run_dof(stamp, para, paths, session=None):
     """
     Set up for multiprocessing. Creates a isolated processing environment,
     where each hydrological river basin is processed separately
@@ -23,6 +25,9 @@ def run_dof(stamp, para, paths):
     :param stamp: timestamp
     :param para: parameters
     :param paths: pathnames
+    :param session: optional tools.session.Session of the model run. The
+        results are then handed over to the next stages instead of being
+        written into the stream feature class right away
     :return:
     """
 
@@ -41,6 +46,29 @@ def run_dof(stamp, para, paths):
 
     use_dam_level_df = para["use_dam_level_df"]
 
+    # Optional series of discharge range factors for a sensitivity analysis,
+    # e.g. "2;5;10". The DOF of each factor goes into its own field
+    drf_sweep = get_sweep(tool.get_para(para, "drf_sweep", ""))
+    if drf_sweep is not None:
+        dof_fields = get_sweep_fields(dof_field, drf_sweep)
+        print ("Discharge range factors of the sweep: %s" % drf_sweep)
+    else:
+        dof_fields = [dof_field]
+
+    # Optional folder that keeps the DOF footprint of each dam between runs.
+    # Reruns then only calculate the dams that changed
+    cache_folder = tool.get_para(para, "dof_cache_folder", "")
+    if cache_folder:
+        tool.create_path(cache_folder)
+        print ("Using DOF footprint cache in {}".format(cache_folder))
+
+    # Folder of the compiled stream network, number of worker processes,
+    # and number of tasks submitted at a time
+    network_folder, workers, max_in_flight = tool.get_run_settings(para)
+
+    # Split the dams of very large basins over several workers
+    split_basins = tool.get_para(para, "split_basins", "yes")
+
     gdb_full_path = paths["gdb_full_path"]
 
     output_folder = para["output_folder"]
@@ -54,178 +82,176 @@ def run_dof(stamp, para, paths):
     print ("Discharge range factor used (upstream): %s" % drf_upstream)
     print ("Discharge range factor used (downstream): %s" % drf_downstream)
 
-    in_basins = list(get_unique(dam_fc, barrier_inc_field))
+    dams = load_dam_table(dam_fc, barrier_inc_field, use_dam_level_df,
+                          session)
+    in_basins = list(get_unique(dams, barrier_inc_field))
 
     print ("Loading {}".format(str(streams_fc)))
-    streams = load_streams(streams_fc, dof_field)
-    dams_temp = load_dams(dam_fc, barrier_inc_field, use_dam_level_df)
-
-    pooled = True
+    streams = load_streams(streams_fc, dof_fields, network_folder)
+    dams_temp = load_dams(dams, barrier_inc_field, use_dam_level_df)
+    dams = None
+
+    # The stream and dam arrays are shared with the workers through files in
+    # the scratch workspace. Each worker only receives the rows of its basins,
+    # and writes its DOF values into the same rows of the output file
+    streams, stream_rows = tool.sort_by_basin(streams)
+    dams_temp, dam_rows = tool.sort_by_basin(dams_temp)
+
+    streams_path = parallel.share_array(streams, scratch_ws, "streams")
+    dams_path = parallel.share_array(dams_temp, scratch_ws, "dams")
+    output_path = parallel.create_output(scratch_ws, "dof", streams.shape[0],
+                                         dof_fields)
+
+    # Small basins are bundled into tasks of similar size, and the tasks
+    # that take longest are started first. As the DOF of a reach is the
+    # maximum over all dams, the dams of very large basins can be split over
+    # several workers. Not with the footprint cache, which is kept per basin
+    if split_basins.lower() == "yes" and not cache_folder:
+        max_parts = workers
+    else:
+        max_parts = 1
+
+    costs = parallel.basin_costs(streams, dams_temp, stream_rows)
+    tasks = parallel.make_tasks(in_basins, costs, stream_rows, dam_rows,
+                                workers * 16, max_parts)
+
+    # Each part of a split basin writes its DOF values into its own slot of
+    # rows, and the parts are merged from there
+    n_slots = parallel.slot_rows(tasks)
+    if n_slots > 0:
+        parts_path = parallel.create_output(scratch_ws, "dof_parts", n_slots,
+                                            dof_fields)
+    else:
+        parts_path = None
 
-    if pooled:
-        pool = multiprocessing.Pool(8)
+    streams = None
+    dams_temp = None
 
-        jobs = []
-        i = 1
+    # Arguments of run_basin after the basin
+    args = (dof_field,
+            drf_upstream,
+            drf_downstream,
+            dof_mode,
+            use_dam_level_df,
+            cache_folder,
+            drf_sweep)
 
-        print ("Starting analysis pooled")
+    pooled = True
 
-        for basin in in_basins:
-            # https://stackoverflow.com/a/8533626/344647
-            # Much faster than querying the global dataset on disk is
-            # to load the global dataset into memory first and then query it
-            # using numpy methods
-            streams_sel = np.copy(streams[streams[fd.BAS_ID] == basin])
+    if pooled:
+        pool = multiprocessing.Pool(workers)
 
-            # Also faster than querying the feature dataset on disk,
-            # it is better to to load it once and then
-            # use numpy indexing to get the dams we want
-            dams_sel = np.copy(dams_temp[dams_temp[fd.BAS_ID] == basin])
+        print ("Starting analysis pooled with {} workers".format(workers))
 
-            jobs.append(pool.apply_async(run_basin, (streams_sel, dams_sel, basin,
-                                                     stamp + str(i),
-                                                     scratch_ws,
-                                                     dof_field,
-                                                     drf_upstream,
-                                                     drf_downstream,
-                                                     dof_mode,
-                                                     use_dam_level_df)))
+        # Tasks are submitted as earlier tasks complete, and their results
+        # are merged right away
+        jobs = parallel.bounded_map(
+            pool, parallel.run_bundle,
+            ((run_basin, streams_path, dams_path, output_path, task, args,
+              parts_path)
+             for task in tasks),
+            max_in_flight)
 
-            i += 1
+        out_basin = parallel.merge_partials(output_path, jobs, parts_path)
 
         pool.close()
         pool.join()
 
-        out_basin = [job.get() for job in jobs]
-
     else:
 
-        jobs = []
-        i = 1
-
         print ("Starting analysis unpooled")
-        for basin in in_basins:
-            # https://stackoverflow.com/a/8533626/344647
-            # Much faster than querying the global dataset on disk is
-            # to load the global dataset into memory first and then query it
-            # using numpy methods
-            streams_sel = np.copy(streams[streams[fd.BAS_ID] == basin])
-
-            # Also faster than querying the feature dataset on disk,
-            # it is better to to load it once and then
-            # use numpy indexing to get the dams we want
-            dams_sel = np.copy(dams_temp[dams_temp[fd.BAS_ID] == basin])
-
-            jobs.append(run_basin(streams_sel,
-                                  dams_sel,
-                                  basin,
-                                  stamp + str(i),
-                                  scratch_ws,
-                                  dof_field,
-                                  drf_upstream,
-                                  drf_downstream,
-                                  dof_mode,
-                                  use_dam_level_df))
-            i += 1
-
-        out_basin = [job for job in jobs]
-
-    # Merge the temporary outputs
-    print("Merging temporary outputs into output table %s ..." % gdb_full_path)
-
-    i = 0
-    tbl = {}
-    for bas in out_basin:
-        i += 1
-
-        with open(bas, 'rb') as fp:
-            tbl[i] = cPickle.load(fp)
-
-    merged = np.concatenate(tbl.values(), 1)
-
-    df = pd.DataFrame(merged)
-
-    # Turn panda to numpy
-    # https://my.usgs.gov/confluence/display/cdi/pandas.DataFrame+to+ArcGIS+Table
-    x = np.array(np.rec.fromrecords(df.values))
-    names = df.dtypes.index.tolist()
-    x.dtype.names = tuple(names)
+
+        jobs = (parallel.run_bundle(run_basin, streams_path, dams_path,
+                                    output_path, task, args, parts_path)
+                for task in tasks)
+
+        out_basin = parallel.merge_partials(output_path, jobs, parts_path)
+
+    # Collect the DOF values of all processed basins
+    print("Writing results into output table %s ..." % gdb_full_path)
+
+    results = parallel.collect_results(streams_path, output_path, out_basin)
 
     output_table_location = gdb_full_path + "\\" + "dof"
 
-    arcpy.da.NumPyArrayToTable(x, output_table_location)
-    tool.add_index(lyr=merged, field_name="GOID")
+    arcpy.da.NumPyArrayToTable(results, output_table_location)
+    tool.add_index(lyr=output_table_location, field_name="GOID")
 
-    # Update automatically
-    if update_stream_mode.lower() == "yes":
+    # Update automatically. The fields of a sweep are only written to the
+    # output table
+    if update_stream_mode.lower() == "yes" and drf_sweep is not None:
+        print ("Sweep results are not copied into {}".format(streams_fc))
+
+    elif update_stream_mode.lower() == "yes" and session is not None:
+        session.hand_off(dof_field, results[fd.GOID], results[dof_field])
+
+    elif update_stream_mode.lower() == "yes":
         print "Updating dof values in database {} ".format(streams_fc)
 
-        tool.copy_between(to_join_fc=streams_fc,
-                          to_join_field="GOID",
-                          IntoJoinField=dof_field,
-                          FromJoinFC=output_table_location,
-                          FromJoinField="GOID",
-                          FromValueField=dof_field,
-                          over_mode=True,
-                          over_value=0)
+        tool.write_columns(streams_fc, results[fd.GOID],
+                           [(dof_field, results[dof_field])],
+                           over_mode=True, over_value=0)
 
     tool.delete_path(scratch_ws)
 
 
-def run_basin(streams, dams, basin, stamp, scratchws, dof_field, drf_upstream,
-              drf_downstream, mode, use_dam_level_df):
+def run_basin(streams, dams, basin, dof_field, drf_upstream, drf_downstream,
+              mode, use_dam_level_df, cache_folder="", drf_sweep=None):
     """
     Calculate DOF for all barriers in a specified river basin
 
     :param streams:
     :param dams:
     :param basin:
-    :param stamp:
-    :param scratchws:
     :param dof_field:
     :param drf_upstream:
     :param drf_downstream:
     :param mode:
     :param use_dam_level_df:
-    :return:
+    :param cache_folder: folder of the DOF footprint cache, empty if not used
+    :param drf_sweep: list of discharge range factors to calculate at once,
+        None for a single run with drf_upstream and drf_downstream
+    :return: stream array with the DOF values
     """
 
-    # Setup isolated path and environment
-    temp_out_folder = set_environment(scratchws, basin, stamp)
-
     # Update network ids for rivers and dams
     tool.update_stream_routing_index(streams)
     tool.update_dam_routing_index(dams, streams)
+    topo = topology.build_topology(streams)
+
+    if drf_sweep is not None:
+        # Sweep: one field per factor, see load_streams
+        dof_field = get_sweep_fields(dof_field, drf_sweep)
+        cache_folder = ""
+
+    if cache_folder:
+        cache = load_footprints(cache_folder, basin)
+        cached_keys = set(cache)
+    else:
+        cache = None
 
     # Calculate and write DOF into designated field
     indices.dof.calculate_DOF(dams, streams, mode, dof_field,
-                              drf_upstream, drf_downstream, use_dam_level_df)
+                              drf_upstream, drf_downstream, use_dam_level_df,
+                              topo, cache, drf_sweep)
 
-    # Export table to temporay geodatabase
-    final_table = export(streams, basin, temp_out_folder)
+    if cache_folder and set(cache) != cached_keys:
+        save_footprints(cache, cache_folder, basin)
 
-    # returns the path to table for later merging
-    return final_table
+    return streams
 
 
-def get_unique(dam_table, inc_field):
+def get_unique(dams, inc_field):
     """
     Calculates a list of unique river basins that need to be processed based
     on the barriers to be considered.
 
-    :param dam_table: numpy array with dams to process
+    :param dams: numpy array with all dams, see load_dam_table
     :param inc_field: field to determine dams to include
     :return: List of river basins
     """
 
-    flds = [fd.BAS_ID, inc_field]
-    where_clause = inc_field + ' = 1'
-    where_clause = where_clause.replace("'", "")
-
-    dams = arcpy.da.TableToNumPyArray(
-        dam_table, flds, where_clause, null_value=-1)
-
-    in_basins = np.unique(dams[fd.BAS_ID])
+    in_basins = np.unique(dams[fd.BAS_ID][dams[inc_field] == 1])
 
     if 0 in in_basins:
         sys.exit(
@@ -236,84 +262,145 @@ def get_unique(dam_table, inc_field):
     return in_basins
 
 
-def set_environment(scratch_ws, basin, stamp):
+def get_dam_fields(inc_field, use_dam_level_df):
     """
-    Creates isolated output paths for specific basin using timestamp in scratch workspace.
+    Fields of the dams used in the DOF calculation
 
-    :param scratch_ws: scratch workspace
-    :param basin:  river basin to process
-    :param stamp: timestamp
-    :return: fully specified pathname
+    :param inc_field:
+    :param use_dam_level_df:
+    :return: list of fields
     """
+    if use_dam_level_df.lower() == "yes":
 
-    out_folder = "basin_" + str(basin) + "_" + str(stamp)
-    fullpath = os.path.join(scratch_ws, out_folder)
+        flds = [fd.BAS_ID, fd.GOID, fd.STOR_MCM, fd.DFU, fd.DFD,
+                inc_field]
 
-    tool.create_path(fullpath)
-    return fullpath
+    else:
+        flds = [fd.BAS_ID, fd.GOID, fd.STOR_MCM, inc_field]
+
+    return flds
 
 
-def load_dams(dam_table, inc_field, use_dam_level_df):
+def load_dam_table(dam_table, inc_field, use_dam_level_df, session=None):
     """
-    This function loads from the database
+    Reads all dams from the database, once for the basin list and the dams
+    to process. With a session, the dams are read once for all stages
 
     :param dam_table:
     :param inc_field:
     :param use_dam_level_df:
-    :return: numpy array with dams
+    :param session: optional tools.session.Session of the model run
+    :return: numpy array with all dams
     """
-    if use_dam_level_df.lower() == "yes":
+    flds = get_dam_fields(inc_field, use_dam_level_df) + [fd.INC]
 
-        flds = [fd.BAS_ID, fd.GOID, fd.STOR_MCM, fd.DFU, fd.DFD,
-                inc_field]
+    if session is not None:
+        return session.load_dams(dam_table, flds)
 
-    else:
-        flds = [fd.BAS_ID, fd.GOID, fd.STOR_MCM, inc_field]
+    return tool.load_dam_table(dam_table, flds)
 
-    tool.check_fields(dam_table, flds)
 
-    whereBClause2 = inc_field + ' > 0'
-    whereBClause3 = ' AND ' + fd.INC + ' > 0'
-    whereBClause4 = whereBClause2 + whereBClause3
-    whereBClause5 = whereBClause4.replace("'", "")
+def load_dams(dams, inc_field, use_dam_level_df):
+    """
+    Selects the dams to process
 
-    dams = arcpy.da.TableToNumPyArray(
-        dam_table, flds, whereBClause5, null_value=0)
+    :param dams: numpy array with all dams, see load_dam_table
+    :param inc_field:
+    :param use_dam_level_df:
+    :return: numpy array with dams
+    """
+    flds = get_dam_fields(inc_field, use_dam_level_df)
 
-    return dams
+    sel = (dams[inc_field] > 0) & (dams[fd.INC] > 0)
 
+    return tool.take_fields(dams, flds, sel)
 
-def load_streams(stream_table, dof_field):
+
+def load_streams(stream_table, dof_fields, network_folder=""):
     """
-    Loads the streams and adds a field for holding the DOF values
+    Loads the streams and adds fields for holding the DOF values
 
     :param stream_table: numpy array representing the river reaches
-    :param dof_field: field name to store DOF results
+    :param dof_fields: field names to store DOF results
+    :param network_folder: folder of the compiled stream network, see
+        tools.network. Empty to read the feature class
     :return:
     """
-    flds = [fd.BAS_ID, fd.GOID, fd.NOID, fd.NDOID, fd.NUOID, fd.RIV_ORD,
+    flds = [fd.BAS_ID, fd.GOID, fd.NOID, fd.NDOID, fd.RIV_ORD,
             fd.DIS_AV_CMS, fd.HYFALL]
 
     tool.check_fields(stream_table, flds)
 
-    arr = arcpy.da.TableToNumPyArray(stream_table, flds, null_value=0)
-    arr = tool.add_fields(arr, [(str(dof_field), 'f4')])
-    arr[dof_field] = 0
+    arr = network.load_fields(stream_table, flds, network_folder,
+                              null_value=0)
+    arr = tool.add_fields(arr, [(str(f), 'f4') for f in dof_fields])
+    for f in dof_fields:
+        arr[f] = 0
     return arr
 
 
-def export(streams, basin, folder):
-    suffix = ".bas"
-    name = "out_" + str(basin)
-    fullname = name + suffix
+def get_sweep(value):
+    """
+    Reads the discharge range factors of a sweep from the settings. Factors
+    are separated by semicolons, and a factor can be given as a pair
+    upstream:downstream, e.g. "2;5;10:2"
+
+    :param value: value of the parameter drf_sweep
+    :return: list of factors or (upstream, downstream) pairs, None if empty
+    """
+    value = str(value).strip()
+    if not value:
+        return None
+
+    factors = []
+    for item in value.split(";"):
+        if ":" in item:
+            up, down = item.split(":")
+            factors.append((float(up), float(down)))
+        else:
+            factors.append((float(item), float(item)))
+    return factors
 
-    fullpath = os.path.join(folder, fullname)
 
-    tool.save_as_cpickle(pickle_object=streams,
-                         folder=folder,
-                         name=name,
-                         file_extension=suffix)
-    return fullpath
+def get_sweep_fields(dof_field, drf_sweep):
+    """
+    Names of the DOF fields of a sweep, e.g. DOF_1, DOF_2, ...
+
+    :param dof_field: field name to store DOF results
+    :param drf_sweep: list of discharge range factors
+    :return: list of field names
+    """
+    return [dof_field + "_" + str(k + 1) for k in range(len(drf_sweep))]
+
+
+def load_footprints(cache_folder, basin):
+    """
+    Loads the DOF footprints of the dams of a basin from the cache
+
+    :param cache_folder: folder of the DOF footprint cache
+    :param basin: river basin
+    :return: dictionary of footprints, see indices.dof.footprint_key
+    """
+    cache = tool.load_cpickle(cache_folder, "dof_" + str(basin), ".fpc")
+    if cache is None:
+        cache = {}
+    return cache
+
+
+def save_footprints(cache, cache_folder, basin):
+    """
+    Saves the DOF footprints of the dams of a basin to the cache
+
+    :param cache: dictionary of footprints
+    :param cache_folder: folder of the DOF footprint cache
+    :param basin: river basin
+    :return:
+    """
+    tool.save_as_cpickle(pickle_object=cache,
+                         folder=cache_folder,
+                         name="dof_" + str(basin),
+                         file_extension=".fpc",
+                         protocol=cPickle.HIGHEST_PROTOCOL)
 
 
 def create_gdb_workspace(gdb_folder, gdb_name):
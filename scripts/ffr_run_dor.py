@@ -1,4 +1,3 @@
-import cPickle
 import multiprocessing
 import os
 import sys
@@ -6,16 +5,18 @@ import time
 
 import arcpy
 import numpy as np
-import pandas as pd
 
 import indices.dor
 import tools.helper as tool
+import tools.network as network
+import tools.parallel as parallel
+import tools.topology as topology
 from config import config
 
 fd = config.var
 
 
-def run_dor(stamp, para, paths):
+def run_dor(stamp, para, paths, session=None):
     """
     Set up for multiprocessing. Creates a isolated processing environment,
     where each hydrological river basin is processed separately
@@ -23,6 +24,9 @@ def run_dor(stamp, para, paths):
     :param stamp: timestamp
     :param para: parameters
     :param paths: pathnames
+    :param session: optional tools.session.Session of the model run. The
+        results are then handed over to the next stages instead of being
+        written into the stream feature class right away
     :return:
     """
 
@@ -34,6 +38,10 @@ def run_dor(stamp, para, paths):
     barrier_inc_field = para["barrier_inc_field"]
     dor_field = para["dor_field"]
 
+    # Folder of the compiled stream network, number of worker processes,
+    # and number of tasks submitted at a time
+    network_folder, workers, max_in_flight = tool.get_run_settings(para)
+
     gdb_full_path = paths["gdb_full_path"]
 
     output_folder = para["output_folder"]
@@ -43,158 +51,124 @@ def run_dor(stamp, para, paths):
 
     tool.create_path(scratch_ws)
 
-    in_basins = list(get_unique(dams_fc, barrier_inc_field))
+    dams = load_dam_table(dams_fc, barrier_inc_field, session)
+    in_basins = list(get_unique(dams, barrier_inc_field))
 
     print dams_fc
     print ("Loading {}".format(str(streams_fc)))
-    streams = load_streams(streams_fc, dor_field)
-    dams_temp = load_dams(dams_fc, barrier_inc_field)
+    streams = load_streams(streams_fc, dor_field, network_folder)
+    dams_temp = load_dams(dams, barrier_inc_field)
+    dams = None
+
+    # The stream and dam arrays are shared with the workers through files in
+    # the scratch workspace. Each worker only receives the rows of its basins,
+    # and writes its DOR values into the same rows of the output file
+    streams, stream_rows = tool.sort_by_basin(streams)
+    dams_temp, dam_rows = tool.sort_by_basin(dams_temp)
+
+    streams_path = parallel.share_array(streams, scratch_ws, "streams")
+    dams_path = parallel.share_array(dams_temp, scratch_ws, "dams")
+    output_path = parallel.create_output(scratch_ws, "dor", streams.shape[0],
+                                         [dor_field])
+
+    # Small basins are bundled into tasks of similar size, and the tasks
+    # that take longest are started first
+    costs = parallel.basin_costs(streams, dams_temp, stream_rows)
+    tasks = parallel.make_tasks(in_basins, costs, stream_rows, dam_rows,
+                                workers * 16)
+
+    streams = None
+    dams_temp = None
+
+    # Arguments of run_basin after the basin
+    args = (dor_field,)
 
     pooled = True
 
     if pooled:
-        pool = multiprocessing.Pool(8)
+        pool = multiprocessing.Pool(workers)
 
-        jobs = []
-        i = 1
+        print ("Starting analysis pooled with {} workers".format(workers))
 
-        print ("Starting analysis pooled")
-        for basin in in_basins:
-            # https://stackoverflow.com/a/8533626/344647
-            # Much faster than querying the global dataset on disk is
-            # to load the global dataset into memory first and then query it
-            # using numpy methods
-            streams_sel = np.copy(streams[streams[fd.BAS_ID] == basin])
+        # Tasks are submitted as earlier tasks complete, and their results
+        # are merged right away
+        jobs = parallel.bounded_map(
+            pool, parallel.run_bundle,
+            ((run_basin, streams_path, dams_path, output_path, task, args)
+             for task in tasks),
+            max_in_flight)
 
-            # Also faster than querying the feature dataset on disk,
-            # it is better to to load it once and then
-            # use numpy indexing to get the dams we want
-            dams_sel = np.copy(dams_temp[dams_temp[fd.BAS_ID] == basin])
-
-            jobs.append(pool.apply_async(run_basin, (streams_sel, dams_sel, basin,
-                                                     stamp + str(i), scratch_ws, dor_field)))
-            i += 1
+        out_basin = parallel.merge_partials(output_path, jobs)
 
         pool.close()
         pool.join()
 
-        out_basin = [job.get() for job in jobs]
-
     else:
 
-        jobs = []
-        i = 1
-
         print ("Starting analysis unpooled")
-        for basin in in_basins:
-            # https://stackoverflow.com/a/8533626/344647
-            # Much faster than querying the global dataset on disk is
-            # to load the global dataset into memory first and then query it
-            # using numpy methods
-            streams_sel = np.copy(streams[streams[fd.BAS_ID] == basin])
-
-            # Also faster than querying the feature dataset on disk,
-            # it is better to to load it once and then
-            # use numpy indexing to get the dams we want
-            dams_sel = np.copy(dams_temp[dams_temp[fd.BAS_ID] == basin])
-
-            jobs.append(
-                run_basin(streams_sel, dams_sel, basin, stamp + str(i), scratch_ws, dor_field))
-            i += 1
-
-        out_basin = [job for job in jobs]
 
-    # Merge the temporary outputs
-    print("Merging temporary outputs into output table %s ..." % gdb_full_path)
+        jobs = (parallel.run_bundle(run_basin, streams_path, dams_path,
+                                    output_path, task, args)
+                for task in tasks)
 
-    i = 0
-    tbl = {}
-    for bas in out_basin:
-        i += 1
+        out_basin = parallel.merge_partials(output_path, jobs)
 
-        with open(bas, 'rb') as fp:
-            tbl[i] = cPickle.load(fp)
+    # Collect the DOR values of all processed basins
+    print("Writing results into output table %s ..." % gdb_full_path)
 
-    merged = np.concatenate(tbl.values(), 1)
-
-    df = pd.DataFrame(merged)
-
-    # Turn panda to numpy
-    # https://my.usgs.gov/confluence/display/cdi/pandas.DataFrame+to+ArcGIS+Table
-    x = np.array(np.rec.fromrecords(df.values))
-    names = df.dtypes.index.tolist()
-    x.dtype.names = tuple(names)
+    results = parallel.collect_results(streams_path, output_path, out_basin)
 
     output_table_location = gdb_full_path + "\\" + "dor"
 
-    arcpy.da.NumPyArrayToTable(x, output_table_location)
-    tool.add_index(lyr=merged, field_name="GOID")
+    arcpy.da.NumPyArrayToTable(results, output_table_location)
+    tool.add_index(lyr=output_table_location, field_name="GOID")
 
-    # Update automatically
-    if update_mode == "YES":
+    # Update automatically, or hand the results over to the next stages
+    if update_mode == "YES" and session is not None:
+        session.hand_off(dor_field, results[fd.GOID], results[dor_field])
+
+    elif update_mode == "YES":
         print("Updating dor values in database {} ".format(streams_fc))
 
-        tool.copy_between(to_join_fc=streams_fc,
-                          to_join_field="GOID",
-                          IntoJoinField=dor_field,
-                          FromJoinFC=output_table_location,
-                          FromJoinField="GOID",
-                          FromValueField=dor_field,
-                          over_mode=True,
-                          over_value=0)
+        tool.write_columns(streams_fc, results[fd.GOID],
+                           [(dor_field, results[dor_field])],
+                           over_mode=True, over_value=0)
 
     tool.delete_path(scratch_ws)
 
 
-def run_basin(streams, dams, basin, stamp, scratchws, dor_field):
+def run_basin(streams, dams, basin, dor_field):
     """
     Calculate DOR for all barriers in a specified river basin
 
     :param streams:
     :param dams:
     :param basin:
-    :param stamp:
-    :param scratchws:
-    :param dof_field:
-    :param drf_upstream:
-    :param drf_downstream:
-    :param mode:
-    :param use_dam_level_df:
-    :return:
+    :param dor_field:
+    :return: stream array with the DOR values
     """
-    scratch_gdb = set_environment(scratchws, basin, stamp)
-
     tool.update_stream_routing_index(streams)
     tool.update_dam_routing_index(dams, streams)
+    topo = topology.build_topology(streams)
 
     print ("Calculating DOR for basin {}".format(str(basin)))
 
-    indices.dor.calculate_dor(dams, streams, dor_field)
+    indices.dor.calculate_dor(dams, streams, dor_field, topo)
 
-    final_table = export(streams, basin, scratch_gdb)
+    return streams
 
-    # Return only reference (path) to table
-    return final_table
 
-
-def get_unique(dam_table, inc_field):
+def get_unique(dams, inc_field):
     """
     Calculates a list of unique river basins that need to be processed based
     on the barriers to be considered.
 
-    :param dam_table: umpy array with dams to process
+    :param dams: numpy array with all dams, see load_dam_table
     :param inc_field: field to determine dams to include
     :return: List of river basins
     """
 
-    flds = [fd.BAS_ID, inc_field]
-    whereBClause = inc_field + ' = 1'
-    whereBClause = whereBClause.replace("'", "")
-
-    dams = arcpy.da.TableToNumPyArray(
-        dam_table, flds, whereBClause, null_value=-1)
-
-    in_basins = np.unique(dams[fd.BAS_ID])
+    in_basins = np.unique(dams[fd.BAS_ID][dams[inc_field] == 1])
 
     if 0 in in_basins:
         sys.exit(
@@ -205,80 +179,62 @@ def get_unique(dam_table, inc_field):
     return in_basins
 
 
-def set_environment(scratch_ws, basin, stamp):
+def load_dam_table(dam_table, inc_field, session=None):
     """
-    Creates isolated output paths for specific basin using timestamp in scratch workspace.
+    Reads all dams from the database, once for the basin list and the dams
+    to process. With a session, the dams are read once for all stages
 
-    :param scratch_ws: scratch workspace
-    :param basin:  river basin to process
-    :param stamp: timestamp
-    :return: fully specified pathname
+    :param dam_table:
+    :param inc_field:
+    :param session: optional tools.session.Session of the model run
+    :return: numpy array with all dams
     """
+    flds = [fd.BAS_ID, fd.GOID, fd.STOR_MCM, fd.INC, inc_field]
 
-    out_folder = "basin_" + str(basin) + "_" + str(stamp)
-    fullpath = os.path.join(scratch_ws, out_folder)
+    if session is not None:
+        return session.load_dams(dam_table, flds)
 
-    tool.create_path(fullpath)
-    return fullpath
+    return tool.load_dam_table(dam_table, flds)
 
 
-def load_dams(dam_table, inc_field):
+def load_dams(dams, inc_field):
     """
-    This function loads from the database
+    Selects the dams to process
 
-    :param dam_table:
+    :param dams: numpy array with all dams, see load_dam_table
     :param inc_field:
-    :param use_dam_level_df:
     :return: numpy array with dams
     """
     flds = [fd.BAS_ID, fd.GOID, fd.STOR_MCM, fd.INC, inc_field]
 
-    tool.check_fields(dam_table, flds + [fd.INC])
-
-    whereBClause2 = inc_field + ' > 0'
-    whereBClause3 = ' AND ' + fd.INC + ' > 0'
-    whereBClause4 = whereBClause2 + whereBClause3
-    whereBClause5 = whereBClause4.replace("'", "")
-
-    dams = arcpy.da.TableToNumPyArray(dam_table, flds, whereBClause5, null_value=0)
+    sel = (dams[inc_field] > 0) & (dams[fd.INC] > 0)
 
-    return dams
+    return tool.take_fields(dams, flds, sel)
 
 
-def load_streams(stream_table, dor_field):
+def load_streams(stream_table, dor_field, network_folder=""):
     """
     Loads the streams and adds a field for holding the DOF values
 
     :param stream_table: numpy array representing the river reaches
     :param dor_field: field name to store DOR results
+    :param network_folder: folder of the compiled stream network, see
+        tools.network. Empty to read the feature class
     :return:
     """
 
-    flds = [fd.BAS_ID, fd.GOID, fd.NOID, fd.NDOID, fd.NUOID, fd.RIV_ORD,
+    flds = [fd.BAS_ID, fd.GOID, fd.NOID, fd.NDOID, fd.RIV_ORD,
             fd.DIS_AV_CMS, fd.HYFALL]
 
     tool.check_fields(stream_table, flds)
 
-    arr = arcpy.da.TableToNumPyArray(stream_table, flds, null_value=0)
+    arr = network.load_fields(stream_table, flds, network_folder,
+                              null_value=0)
     arr = tool.add_fields(arr, [(str(dor_field), 'f4')])
     arr[dor_field] = 0
     return arr
 
 
-def export(streams, basin, folder):
-    suffix = ".bas"
-    name = "out_" + str(basin)
-    fullname = name + suffix
-
-    fullpath = os.path.join(folder, fullname)
-
-    tool.save_as_cpickle(pickle_object=streams,
-                         folder=folder,
-                         name=name,
-                         file_extension=suffix)
-    return fullpath
-
-
 def create_gdb_workspace(gdb_folder, gdb_name):
     """
     Creates a path and a geodatabase with timestamp
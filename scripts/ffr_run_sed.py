@@ -1,22 +1,30 @@
 import logging
+import multiprocessing
+import os
 import sys
-from collections import defaultdict
 
 import arcpy
+import numpy as np
 
 import indices.sed
 from config import config
 from tools import helper
+from tools import network
+from tools import parallel
+from tools import topology
 
 fd = config.var
 
 
-def run_sed(para, paths):
+def run_sed(para, paths, session=None):
     """
     Script to calculate the Sediment Trapping Index (SED)
 
     :param para: input parameters and path names for executing the script
     :param paths: output pathnames
+    :param session: optional tools.session.Session of the model run. The
+        results are then handed over to the next stages instead of being
+        written into the stream feature class right away
     :return:
     """
     streams_fc = para["streams_fc"]
@@ -27,54 +35,197 @@ def run_sed(para, paths):
     sed_field = para["sed_field"]
     out_gdb = paths["gdb_full_path"]
 
-    streams = load_streams(streams_fc)
-    streams, convert_dict = update_stream_routing_index(streams)
+    # Folder of the compiled stream network, number of worker processes,
+    # and number of tasks submitted at a time
+    network_folder, workers, max_in_flight = helper.get_run_settings(para)
 
-    barriers = load_barriers(dams_fc, convert_dict,
-                             svol_field, barrier_inc_field)
-    dam_volu_dict = barriers_calculate(barriers, svol_field)
+    # Calculate the river basins in parallel, with the same workers as DOF
+    # and DOR
+    sed_parallel = helper.get_para(para, "sed_parallel", "no")
 
-    lakes = load_lakes(lakes_fc, convert_dict)
+    streams = load_streams(streams_fc, network_folder)
+    streams = update_stream_routing_index(streams)
 
-    small_lake_loss_dict, lake_volu_dict = indices.sed.lakes_calculate(lakes)
+    dams = load_dam_table(dams_fc, svol_field, barrier_inc_field, session)
+    barriers = load_barriers(dams, streams, svol_field, barrier_inc_field)
+    dam_volu = barriers_calculate(barriers, svol_field, streams.shape[0])
 
-    streams = indices.sed.calculate_sed(streams, dam_volu_dict, lake_volu_dict,
-                                        small_lake_loss_dict)
+    lakes = load_lakes(lakes_fc, streams)
+
+    small_lake_loss, lake_volu = indices.sed.lakes_calculate(
+        lakes, streams.shape[0])
+
+    prt("")
+    prt("***************************************************")
+    prt("PART 2: Calculating natural and anthropogenic")
+    prt("        sediment load and SED index")
+    prt("***************************************************")
+    prt("")
+
+    if sed_parallel.lower() == "yes":
+        scratch_ws = os.path.join(os.path.dirname(out_gdb), "Scratch")
+        results = calculate_parallel(streams, dam_volu, lake_volu,
+                                     small_lake_loss, scratch_ws, workers,
+                                     max_in_flight)
+    else:
+        topo = topology.build_topology(streams)
+        streams = indices.sed.calculate_sed(streams, dam_volu, lake_volu,
+                                            small_lake_loss, topo)
+        results = streams[[fd.GOID, fd.SED]]
 
     prt("Exporting results sediment table")
 
-    outtbl = export_results_table(streams, out_gdb)
+    outtbl = export_results_table(results, out_gdb)
 
     # Adding indices helps with joining tables to geometry
     arcpy.AddIndex_management(outtbl, fd.GOID, fd.GOID, "UNIQUE", "ASCENDING")
 
-    # Update original database
-    if para["update_mode"] == "YES":
+    # Update original database, or hand the results over to the next stages.
+    # Reaches that are not in the stream array keep their SED value
+    if para["update_mode"] == "YES" and session is not None:
+        session.hand_off(sed_field, results[fd.GOID], results[fd.SED],
+                         over_mode=False)
+
+    elif para["update_mode"] == "YES":
         print("Updating SED values in database {} ".format(streams_fc))
         try:
-            helper.copy_between(streams_fc, fd.GOID,
-                                sed_field, outtbl,
-                                fd.GOID, fd.SED,
-                                "overwrite", 0)
+            helper.write_columns(streams_fc, results[fd.GOID],
+                                 [(sed_field, results[fd.SED])],
+                                 over_mode=False)
         except Exception as e:
             print (str(e))
             sys.exit(0)
 
 
-def load_streams(stream_table):
+def calculate_parallel(streams, dam_volu, lake_volu, small_lake_loss,
+                       scratch_ws, workers, max_in_flight):
+    """
+    Calculates SED one river basin at a time in a pool of worker processes,
+    see tools.parallel. Sediments are not routed across basin boundaries, so
+    the basins are independent of each other
+
+    :param streams: stream array with updated routing index, sorted by basin
+    :param dam_volu: volume of the dams of each reach
+    :param lake_volu: volume of the large lakes of each reach
+    :param small_lake_loss: trapping of the small lakes of each reach
+    :param scratch_ws: folder for the files shared with the workers
+    :param workers: number of worker processes
+    :param max_in_flight: largest number of tasks submitted at a time
+    :return: numpy array with the fields GOID and SED, sorted by GOID
+    """
+    check_basins(streams)
+
+    # The stream array is sorted by basin, see update_stream_routing_index
+    stream_rows = helper.basin_offsets(streams[fd.BAS_ID])
+
+    # The dams and lakes are shared as values per reach, with the same rows
+    # as the streams
+    reaches = np.zeros(streams.shape[0], dtype=[("DAM_VOLU", "f8"),
+                                                ("LAKE_VOLU", "f8"),
+                                                ("LAKE_LOSS", "f8")])
+    reaches["DAM_VOLU"] = dam_volu
+    reaches["LAKE_VOLU"] = lake_volu
+    reaches["LAKE_LOSS"] = small_lake_loss
+
+    helper.delete_path(scratch_ws)
+    helper.create_path(scratch_ws)
+
+    streams_path = parallel.share_array(streams, scratch_ws, "sed_streams")
+    reaches_path = parallel.share_array(reaches, scratch_ws, "sed_reaches")
+    output_path = parallel.create_output(scratch_ws, "sed", streams.shape[0],
+                                         [fd.SED], "f8")
+
+    # The time of a basin grows with its number of reaches
+    costs = dict((basin, stop - start)
+                 for basin, (start, stop) in stream_rows.items())
+    tasks = parallel.make_tasks(list(stream_rows), costs, stream_rows,
+                                stream_rows, workers * 16)
+
+    streams = None
+    reaches = None
+
+    pool = multiprocessing.Pool(workers)
+
+    print ("Starting analysis pooled with {} workers".format(workers))
+
+    jobs = parallel.bounded_map(
+        pool, parallel.run_bundle,
+        ((run_basin, streams_path, reaches_path, output_path, task, ())
+         for task in tasks),
+        max_in_flight)
+
+    out_basin = parallel.merge_partials(output_path, jobs)
+
+    pool.close()
+    pool.join()
+
+    results = parallel.collect_results(streams_path, output_path, out_basin)
+
+    helper.delete_path(scratch_ws)
+
+    return results
+
+
+def run_basin(streams, reaches, basin):
+    """
+    Calculate SED for all reaches of a river basin
+
+    :param streams: stream array of the basin, with the network ids of the
+        whole network
+    :param reaches: volumes and trapping of the dams and lakes of the
+        reaches of the basin, see calculate_parallel
+    :param basin: river basin
+    :return: stream array with the SED values
+    """
+    # Network ids within the basin, starting at 1. No reach drains into
+    # another basin, see check_basins
+    offset = streams[fd.NOID][0] - 1
+    streams[fd.NOID] -= offset
+    drains = streams[fd.NDOID] > 0
+    streams[fd.NDOID][drains] -= offset
+
+    topo = topology.build_topology(streams)
+
+    return indices.sed.calculate_sed(streams, reaches["DAM_VOLU"],
+                                     reaches["LAKE_VOLU"],
+                                     reaches["LAKE_LOSS"], topo)
+
+
+def check_basins(streams):
+    """
+    Makes sure that no reach drains into a reach of another river basin,
+    which the basin-wise calculation could not route
+
+    :param streams: stream array with updated routing index
+    """
+    down = streams[fd.NDOID].astype(np.int64) - 1
+    drains = down >= 0
+
+    crossing = streams[fd.BAS_ID][drains] != streams[fd.BAS_ID][down[drains]]
+    if crossing.any():
+        raise Exception("{} reaches drain into another river basin. Set "
+                        "sed_parallel to no".format(int(crossing.sum())))
+
+
+def load_streams(stream_table, network_folder=""):
     """
     Loading stream network and adding fields
 
     :param stream_table:
+    :param network_folder: folder of the compiled stream network, see
+        tools.network. Empty to read the feature class
     :return: stream array with necessary fields
     """
 
     # Existing fields to load
-    flds = [fd.GOID, fd.NOID, fd.NDOID, fd.NUOID, fd.INC,
+    flds = [fd.GOID, fd.NOID, fd.NDOID, fd.INC,
             fd.DIS_AV_CMS, fd.BAS_ID, fd.UPLAND_SKM,
             fd.ERO_YLD_TON]
 
-    arr = arcpy.da.TableToNumPyArray(stream_table, flds)
+    if network_folder:
+        arr = network.load_fields(stream_table, flds, network_folder)
+    else:
+        arr = arcpy.da.TableToNumPyArray(stream_table, flds)
 
     arr = helper.add_fields(arr, [(fd.SED_LSS_LKS_OT_NAT, 'f8')])
     arr = helper.add_fields(arr, [(fd.SED_LSS_LKS_IN_NAT, 'f8')])
@@ -129,61 +280,19 @@ def update_stream_routing_index(streams):
     # This is key to being able to process river network from top to bottom
     streams.sort(order=['BAS_ID', 'UPLAND_SKM'])
 
-    # Create Routing Dictionaries and fill
-    oid_dict = {}
-    convert_dict = {}
-    ups_dict = defaultdict(str)
-    down_dict = defaultdict(long)
-
-    i = 1
-    for myrow in streams:
-        oid_dict[int(myrow["GOID"])] = i
-        i += 1
-
-    i = 1
-    for myrow in streams:
-        dn_old_oid = myrow["NDOID"]
-        new_oid = oid_dict.get(int(dn_old_oid), -1)
-
-        if new_oid != -1:
-            # Write OID of next downstream reach
-            down_dict[i] = new_oid
-            # Write OID of next upstream reach
-            exi_value = ups_dict.get(int(new_oid), -99)
-
-            if exi_value == -99:
-                ups_dict[int(new_oid)] = i
-            else:
-                new_value = str(exi_value) + '_' + str(i)
-                ups_dict[int(new_oid)] = new_value
-        i += 1
-
-    # Writing index values back to numpy
-    i = 1
-    for myrow in streams:
-        myrow["NOID"] = i
-        myrow["NDOID"] = down_dict[i]
-        myrow["NUOID"] = ups_dict[i]
-
-        i = i + 1
-
-    # Create Dictionary to convert old (KEY) to new (VALUE)
-    i = 1
-    for myrow in streams:
-        old = myrow["OGOID"]
-        new = myrow["NOID"]
-        convert_dict[int(old)] = new
-        i += 1
-
-    return streams, convert_dict
-
-
-def load_lakes(lakes_table, convert_dict):
+    # Recalculate the network ids in the new order. GOIDs of dams and lakes
+    # are converted to the new ids with helper.goid_to_noid
+    helper.rebuild_routing_index(streams)
+
+    return streams
+
+
+def load_lakes(lakes_table, streams):
     """
     Load lakes and add field for sediment trapping calculations
 
     :param lakes_table:
-    :param convert_dict:
+    :param streams: stream array with updated routing index
     :return: numpy array of lakes
     """
 
@@ -200,60 +309,73 @@ def load_lakes(lakes_table, convert_dict):
     arr["TE_brune"] = 0
     arr["LOSS_LKES_OUT_NET"] = 0
 
-    for a in arr:
-        a["GOID"] = convert_dict.get(a["GOID"], 0)
+    arr["GOID"] = helper.goid_to_noid(streams, arr["GOID"])
 
     return arr
 
 
-def load_barriers(barriers_table, convert_dict, svol_field, barrier_inc_field):
+def load_dam_table(barriers_table, svol_field, barrier_inc_field,
+                   session=None):
     """
-    Loading dams and converting old to new
+    Reads all dams from the database. With a session, the dams are read
+    once for all stages
 
     :param barriers_table:
-    :param convert_dict:
     :param svol_field:
     :param barrier_inc_field:
-    :return:
+    :param session: optional tools.session.Session of the model run
+    :return: numpy array with all dams
     """
     print("Loading dams")
 
     # Existing fields to load
     flds = [fd.GOID, fd.NOID, svol_field, fd.INC, barrier_inc_field]
 
-    # Load the array from file
-    arr = arcpy.da.TableToNumPyArray(barriers_table, flds, null_value=0)
+    if session is not None:
+        return session.load_dams(barriers_table, flds)
+
+    return helper.load_dam_table(barriers_table, flds)
 
-    for a in arr:
-        a[fd.GOID] = convert_dict.get(a[fd.GOID], 0)
+
+def load_barriers(dams, streams, svol_field, barrier_inc_field):
+    """
+    Selecting dams and converting old to new
+
+    :param dams: numpy array with all dams, see load_dam_table
+    :param streams: stream array with updated routing index
+    :param svol_field:
+    :param barrier_inc_field:
+    :return:
+    """
+    flds = [fd.GOID, fd.NOID, svol_field, fd.INC, barrier_inc_field]
 
     # Select only dams that are included in analysis through field INC or INC1
-    arr2 = arr[(arr[barrier_inc_field] == 1) & (arr[fd.INC] == 1)]
+    sel = (dams[barrier_inc_field] == 1) & (dams[fd.INC] == 1)
+    arr = helper.take_fields(dams, flds, sel)
+
+    arr[fd.GOID] = helper.goid_to_noid(streams, arr[fd.GOID])
 
-    return arr2
+    return arr
 
 
-def barriers_calculate(barriers, svol_field):
+def barriers_calculate(barriers, svol_field, n):
     """
     In some cases, there are multiple reservoirs located on a river reach.
     This function calculates the sum of reservoir volume for each river reach.
 
-    :param barriers:
+    :param barriers: dams, with the network id (NOID) of their reach in GOID
     :param svol_field:
-    :return:
+    :param n: number of reaches in the stream network
+    :return: array with the reservoir volume of each reach, see
+        indices.sed.sum_per_reach
     """
-    dam_volu_dict = {}
-
-    for b in barriers:
-        goid = b[fd.GOID]
-        dam_volu_dict[goid] = dam_volu_dict.get(goid, 0) + b[svol_field]
-
-    return dam_volu_dict
+    return indices.sed.sum_per_reach(barriers[fd.GOID], barriers[svol_field],
+                                     n)
 
 
-def export_results_table(streams, out_gdb):
+def export_results_table(results, out_gdb):
     out_tbl = out_gdb + "\\sed"
-    arcpy.da.NumPyArrayToTable(streams[[fd.GOID, fd.SED]], out_tbl)
+    arcpy.da.NumPyArrayToTable(results[[fd.GOID, fd.SED]], out_tbl)
     return out_tbl
 
 
@@ -25,17 +25,22 @@ def post_stats_bench_single(
     """
 
     bench = _loadBenchTable(bench_fc)
-    bench = bench.set_index([fd.GOID])
 
-    # Now preparing benchmark tables
-    panda_df_for_bench = pd.DataFrame(stream_array_mod)
-    panda_df_for_bench = panda_df_for_bench.set_index([fd.GOID])
-
-    join_bench = pd.merge(
-        panda_df_for_bench,
-        bench,
-        left_index=True,
-        right_index=True)
+    # Now preparing benchmark tables. Only the river reaches of benchmark
+    # rivers are taken from the stream array, found by their GOID
+    rows = tools.find_rows(stream_array_mod[fd.GOID], bench[fd.GOID].values)
+    hit = np.flatnonzero(rows >= 0)
+
+    # Sorted by GOID. The former pandas merge on the GOID index returned
+    # this order if GOIDs repeat in the benchmark table, and the order of
+    # the stream array otherwise. The statistics do not depend on it
+    hit = hit[np.lexsort((hit, bench[fd.GOID].values[hit]))]
+
+    join_bench = pd.DataFrame(stream_array_mod[rows[hit]])
+    for col in bench.columns:
+        if col != fd.GOID:
+            join_bench[col] = bench[col].values[hit]
+    join_bench = join_bench.set_index([fd.GOID])
 
     dom_field_name = scenario_name + str("_D")
     dom_bench = calculate_dominance_bench_rivers(
@@ -0,0 +1,119 @@
+"""
+Checks the vectorized trapping efficiency (indices.sed.TE) against the
+former scalar implementation of the Brune equation
+"""
+
+import math
+import unittest
+
+import numpy as np
+
+import indices.sed
+
+
+def scalar_te(volume, discharge):
+    """
+    Former implementation of indices.sed.TE, one lake or reservoir at a time
+    """
+    if discharge < 0.00000001:
+        te_ratio = 1.0
+    else:
+        vol_dis = (volume * 1000000.0) / (
+                discharge * 60.0 * 60.0 * 24.0 * 365.0)
+        div = math.sqrt(vol_dis)
+
+        if div < 0.00000001:
+            tef = 0
+            te_ratio = 1.0 - tef
+        else:
+            tef = 1.0 - ((0.05) / float(div))
+
+            if tef < 0:
+                tef = 0
+
+            te_ratio = 1.0 - tef
+
+    return te_ratio
+
+
+# Volume of a lake that lies exactly at the ratio threshold (div = 1e-8)
+# for a discharge of 1 CMS
+RATIO_VOLUME = 1e-16 * 60.0 * 60.0 * 24.0 * 365.0 / 1000000.0
+
+EDGE_VOLUMES = [0.0, 1e-20, RATIO_VOLUME * 0.99, RATIO_VOLUME,
+                RATIO_VOLUME * 1.01, 1e-9, 1e-6, 0.0025, 1.0, 1e3, 1e6]
+EDGE_DISCHARGES = [0.0, 0.99e-8, 1e-8, 1.01e-8, 1e-6, 1.0, 1e3, 1e5]
+
+
+def edge_pairs():
+    """
+    All combinations of the edge volumes and discharges
+    """
+    volumes, discharges = np.meshgrid(EDGE_VOLUMES, EDGE_DISCHARGES)
+    return volumes.ravel(), discharges.ravel()
+
+
+def random_pairs(n=20000, seed=0):
+    """
+    Volumes and discharges over many orders of magnitude
+    """
+    rs = np.random.RandomState(seed)
+    volumes = rs.lognormal(0, 5, n)
+    discharges = rs.lognormal(0, 5, n)
+    return volumes, discharges
+
+
+class TestTE(unittest.TestCase):
+
+    def check_array(self, volumes, discharges):
+        expected = [scalar_te(v, d) for v, d in zip(volumes, discharges)]
+        result = indices.sed.TE(volumes, discharges)
+
+        self.assertEqual(result.shape, volumes.shape)
+        np.testing.assert_array_equal(result, expected)
+
+    def check_scalar(self, volumes, discharges):
+        for v, d in zip(volumes, discharges):
+            result = indices.sed.TE(v, d)
+            self.assertIsInstance(result, float)
+            self.assertEqual(result, scalar_te(v, d))
+
+    def test_edge_values(self):
+        volumes, discharges = edge_pairs()
+        self.check_array(volumes, discharges)
+        self.check_scalar(volumes, discharges)
+
+    def test_random_values(self):
+        volumes, discharges = random_pairs()
+        self.check_array(volumes, discharges)
+        self.check_scalar(volumes[:2000], discharges[:2000])
+
+    def test_float32(self):
+        for volumes, discharges in [edge_pairs(), random_pairs()]:
+            volumes = volumes.astype(np.float32)
+            discharges = discharges.astype(np.float32)
+            self.check_array(volumes, discharges)
+            self.check_scalar(volumes[:2000], discharges[:2000])
+
+    def test_thresholds(self):
+        # Discharges below 1e-8 CMS
+        self.assertEqual(indices.sed.TE(1.0, 0.0), 1.0)
+        self.assertEqual(indices.sed.TE(1.0, 0.99e-8), 1.0)
+
+        # Volume/discharge ratios below the threshold
+        self.assertEqual(indices.sed.TE(0.0, 1.0), 1.0)
+        self.assertEqual(indices.sed.TE(RATIO_VOLUME * 0.99, 1.0), 1.0)
+
+        # TEF is clamped at 0
+        self.assertEqual(indices.sed.TE(1e-9, 1e5), 1.0)
+
+        self.assertEqual(indices.sed.TE(1e6, 1.0),
+                         1.0 - (1.0 - 0.05 / math.sqrt(1e12 / 31536000.0)))
+
+    def test_empty(self):
+        result = indices.sed.TE(np.zeros(0), np.zeros(0))
+        self.assertEqual(result.shape, (0,))
+
+
+if __name__ == "__main__":
+    unittest.main()
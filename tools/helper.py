@@ -241,56 +241,56 @@ def update_stream_routing_index(streams):
         Updates and returns the stream network with new network ids
     """
 
-    for n in ["GOID", "NOID", "NDOID", "NUOID"]:
+    for n in ["GOID", "NOID", "NDOID"]:
         if not n in streams.dtype.names:
             raise Exception("Field {} does not exist".format(n))
 
     # river network must be global or extracted from global. NOID NDOID and
     # NUOID must not be sorted
-    if streams["NOID"][0] != streams["GOID"][0]:
+    if streams.shape[0] > 0 and streams["NOID"][0] != streams["GOID"][0]:
         raise Exception("It seems like you are attempting to resort "
                         "a network that has already been sorted. "
                         "This would be confusing, please use an extract of "
                         "the original network")
 
-    # print("Updating routing index")
-    # Create Routing Dictionaries and fill
+    return rebuild_routing_index(streams)
 
-    oidDict = {}
-    upsDict = defaultdict(str)
-    downDict = defaultdict(long)
 
-    i = 1
-    for myrow in streams:
-        oidDict[int(myrow[fd.GOID])] = i
-        i += 1
+def rebuild_routing_index(streams):
+    """
+    Recalculates the network ids from the order of the rows: the reach in
+    row i gets the NOID i + 1, NDOID is set to the NOID of the downstream
+    reach (0 if the downstream reach is not in the array) and, if the field
+    exists, NUOID to the NOIDs of the upstream reaches joined by "_".
+    NDOID must hold the GOID of the downstream reach
 
-    i = 1
-    for myrow in streams:
-        dnOldOID = myrow[fd.NDOID]
-        newOid = oidDict.get(int(dnOldOID), -1)
+    :param streams: numpy array representing the stream network
+    :return: Updates and returns the stream network with new network ids
+    """
+    n = streams.shape[0]
 
-        if newOid != -1:
-            # Write OID of next downstream reach
-            downDict[i] = newOid
-            # Write OID of next upstream reach
-            exValue = upsDict.get(int(newOid), -99)
+    # Position of the downstream reach, found by its GOID
+    down = find_rows(streams[fd.GOID], streams[fd.NDOID])
 
-            if exValue == -99:
-                upsDict[int(newOid)] = i
-            else:
-                newV = str(exValue) + '_' + str(i)
-                upsDict[int(newOid)] = newV
-        i += 1
+    streams[fd.NOID] = np.arange(1, n + 1)
+    streams[fd.NDOID] = down + 1
+
+    if fd.NUOID in streams.dtype.names:
+        streams[fd.NUOID] = ""
+
+        # Upstream reaches grouped by their downstream reach, in row order
+        ups = np.flatnonzero(down >= 0)
+        ups = ups[np.argsort(down[ups], kind="mergesort")]
+
+        if ups.shape[0] > 0:
+            first = np.append(True, down[ups][1:] != down[ups][:-1])
 
-    # Writing index values back to numpy
-    i = 1
-    for myrow in streams:
-        myrow[fd.NOID] = i
-        myrow[fd.NDOID] = downDict[i]
-        myrow[fd.NUOID] = upsDict[i]
+            # Join the ids of each group by adding up the strings
+            ids = (ups + 1).astype(str).astype(object)
+            ids[~first] = "_" + ids[~first]
+            starts = np.flatnonzero(first)
 
-        i = i + 1
+            streams[fd.NUOID][down[ups[starts]]] = np.add.reduceat(ids, starts)
 
     return streams
 
@@ -356,6 +356,58 @@ def copy_between(to_join_fc, to_join_field, IntoJoinField, FromJoinFC,
             cursor.updateRow(row1)
 
 
+def write_columns(table, goids, columns, over_mode=True, over_value=0):
+    """
+    Writes result columns into a table in one pass, joined by GOID. Works
+    like copy_between, but takes the values from numpy arrays instead of a
+    second table, and updates several fields at once
+
+    :param table: table or feature class to update
+    :param goids: GOIDs of the results
+    :param columns: list of (field name, values) pairs, the values aligned
+        with goids
+    :param over_mode: if True, the rows that are not in goids are set to
+        over_value, otherwise they keep their value
+    :param over_value: value of the rows that are not in goids
+    """
+    update_columns(table, [(field, goids, values, over_mode, over_value)
+                           for field, values in columns])
+
+
+def update_columns(table, updates):
+    """
+    Writes several result columns into a table in one pass of an update
+    cursor. Like copy_between, the new value of each row is looked up by
+    GOID, in one dictionary per field
+
+    :param table: table or feature class to update
+    :param updates: list of (field name, GOIDs, values, over_mode,
+        over_value), see write_columns
+    """
+    if not updates:
+        return
+
+    fields = [field for field, _, _, _, _ in updates]
+    lookups = [(dict(zip(np.asarray(goids).tolist(),
+                         np.asarray(values).tolist())), over_mode, over_value)
+               for _, goids, values, over_mode, over_value in updates]
+
+    with arcpy.da.UpdateCursor(table, [fd.GOID] + fields) as cursor:
+        for row in cursor:
+            goid = row[0]
+
+            for k, (new_values, over_mode, over_value) in enumerate(lookups):
+                new_value = new_values.get(goid)
+
+                if new_value is None:
+                    if over_mode is True:
+                        row[k + 1] = over_value
+                else:
+                    row[k + 1] = new_value
+
+            cursor.updateRow(row)
+
+
 def get_writer(base_dir, stamp):
     # Setup a Excel Writer target file
     excel_file_output = os.path.join(base_dir, "results_" + stamp + ".xls")
@@ -568,49 +620,49 @@ def load_parameters(path):
     return sequence, value_dict, sce_list, list(field_set)
 
 
-def load_stream_array(stream_feature_class, stream_fields, use_npy=0,
-                      fname=""):
+def get_para(para, key, default):
     """
-    Loading input stream feature class (river network) to numpy array.
-    Optionally, the stream feature class can bes saved as a numpy memory
-    object and loaded instead, which can be much more efficient (depending
-    on extent)
+    Returns an optional parameter from the settings sheet. Keys that are
+    missing from the sheet, or have an empty value, return the default
+
+    :param para: dictionary of parameters from Excel file
+    :param key: parameter name
+    :param default: default value
+    :return: parameter value
+    """
+    value = para.get(key, default)
+    if value is None or value == "" or pd.isnull(value):
+        return default
+    return value
+
+
+def get_run_settings(para):
+    """
+    Returns the optional settings shared by the DOF, DOR and SED runners
+
+    :param para: dictionary of parameters from Excel file
+    :return: folder of the compiled stream network (empty to read the
+        feature class), number of worker processes, and largest number of
+        tasks submitted to the workers at a time
+    """
+    network_folder = get_para(para, "network_folder", "")
+    workers = int(get_para(para, "workers", 8))
+    max_in_flight = int(get_para(para, "max_tasks_in_flight", 2 * workers))
+
+    return network_folder, workers, max_in_flight
+
+
+def load_stream_array(stream_feature_class, stream_fields):
+    """
+    Loading input stream feature class (river network) to numpy array. To
+    cache the fields between runs, see tools.network.cache_entry
 
     :param stream_feature_class:
     :param stream_fields:
-    :param use_npy:
-    :param fname:
     :return:
     """
-
-    def save_arr(arr, loc):
-        try:
-            np.save(loc, arr)
-        except BaseException:
-            print ("Unexpected error:", sys.exc_info()[0])
-            raise
-
-    def load_arr(loc):
-        try:
-            return np.load(loc)
-        except BaseException:
-            print ("Unexpected error:", sys.exc_info()[0])
-            raise
-
-    if use_npy == 1:
-        if os.path.isfile(fname):
-            print ("Loading stream array from npy object")
-            arr = load_arr(fname)
-        else:
-            print ("Loading stream array from feature class, then save as "
-                   "array")
-            arr = arcpy.da.TableToNumPyArray(stream_feature_class,
-                                             stream_fields)
-            print ("Saving stream array to npy object")
-            save_arr(arr, fname)
-    else:
-        print ("Loading stream array from feature class")
-        arr = arcpy.da.TableToNumPyArray(stream_feature_class, stream_fields)
+    print ("Loading stream array from feature class")
+    arr = arcpy.da.TableToNumPyArray(stream_feature_class, stream_fields)
 
     # Test if Global network or extracted network
     # If extracted, the routing index must be updated
@@ -757,10 +809,66 @@ def remove_csi_traces(fc, name):
                 arcpy.AlterField_management(fc, field.name, fn, fn)
 
 
-def save_as_cpickle(pickle_object, folder, name, file_extension):
+def save_as_cpickle(pickle_object, folder, name, file_extension, protocol=0):
     outfile = os.path.join(folder, str(name) + file_extension)
     with open(outfile, 'wb') as fp:
-        cPickle.dump(pickle_object, fp)
+        cPickle.dump(pickle_object, fp, protocol)
+
+
+def load_cpickle(folder, name, file_extension):
+    """
+    Loads an object saved with save_as_cpickle
+
+    :param folder: folder of the pickle
+    :param name: name of the pickle
+    :param file_extension: file extension of the pickle
+    :return: the object, or None if the file does not exist
+    """
+    infile = os.path.join(folder, str(name) + file_extension)
+    if not os.path.isfile(infile):
+        return None
+    with open(infile, 'rb') as fp:
+        return cPickle.load(fp)
+
+
+def load_dam_table(dam_table, fields):
+    """
+    Reads the dam table in one pass. The dams of a stage are then selected
+    in memory (see take_fields), instead of reading the table again with a
+    where clause. Null values are returned as 0, and as -1 for BAS_ID
+
+    :param dam_table: dam table or feature class
+    :param fields: list of fields to load
+    :return: numpy array with all dams
+    """
+    check_fields(dam_table, fields)
+
+    null_values = dict((f, 0) for f in fields)
+    if fd.BAS_ID in null_values:
+        null_values[fd.BAS_ID] = -1
+
+    return arcpy.da.TableToNumPyArray(dam_table, fields,
+                                      null_value=null_values)
+
+
+def take_fields(array, fields, mask=None):
+    """
+    Copies fields and, optionally, the rows selected by a mask into a new
+    array
+
+    :param array: numpy array
+    :param fields: list of fields to copy, in the order of the new array
+    :param mask: boolean mask of the rows to copy, None for all rows
+    :return: numpy array
+    """
+    if mask is not None:
+        array = array[mask]
+
+    out = np.empty(array.shape[0],
+                   dtype=[(str(f), array.dtype[f]) for f in fields])
+    for f in fields:
+        out[f] = array[f]
+    return out
 
 
 def update_dam_routing_index(dams, arr):
@@ -774,8 +882,84 @@ def update_dam_routing_index(dams, arr):
     return:
         Updates and returns the dam numpy array with new network ids
     """
-    for dam in dams:
-        oldGOID = dam[fd.GOID]
-        find = arr[(arr[fd.GOID]) == oldGOID]
-        new_goid = find[fd.NOID]
-        dam[fd.GOID] = new_goid
+    noid = goid_to_noid(arr, dams[fd.GOID], missing=-1)
+
+    if (noid == -1).any():
+        raise Exception("{} dams are located on river reaches that are not "
+                        "part of the stream network".format((noid == -1).sum()))
+
+    dams[fd.GOID] = noid
+    return dams
+
+
+def find_rows(goids, keys):
+    """
+    Finds the rows that hold the given global ids (GOID), using a sorted
+    copy of the ids and a binary search instead of scanning the array for
+    every key
+
+    :param goids: GOID of each row
+    :param keys: GOIDs to find
+    :return: row of each key, -1 if not found. If a GOID occurs more than
+        once, the last row is returned
+    """
+    goids = np.asarray(goids)
+    keys = np.asarray(keys)
+
+    order = np.argsort(goids, kind="mergesort")
+    sorted_goids = goids[order]
+
+    pos = np.searchsorted(sorted_goids, keys, side="right") - 1
+    found = pos >= 0
+    found[found] = sorted_goids[pos[found]] == keys[found]
+
+    return np.where(found, order[np.maximum(pos, 0)], -1)
+
+
+def goid_to_noid(streams, goids, missing=0):
+    """
+    Converts global ids (GOID) of river reaches, for example of dams or
+    lakes, into the network ids (NOID) of a stream array whose routing index
+    has been updated
+
+    :param streams: numpy array of the stream network
+    :param goids: GOIDs to convert
+    :param missing: value for GOIDs that are not in the stream network
+    :return: NOID of each GOID
+    """
+    rows = find_rows(streams[fd.GOID], goids)
+    return np.where(rows >= 0, streams[fd.NOID][np.maximum(rows, 0)], missing)
+
+
+def sort_by_basin(array):
+    """
+    Sorts an array by basin, so that the rows of each basin can be taken as
+    a slice (see basin_offsets) instead of being selected with a mask. The
+    sort is stable, the rows within a basin keep their order
+
+    :param array: numpy array with the field BAS_ID
+    :return: sorted array, and a dictionary with the first and last
+        (exclusive) row of each basin
+    """
+    order = np.argsort(array[fd.BAS_ID], kind="mergesort")
+    array = array[order]
+    return array, basin_offsets(array[fd.BAS_ID])
+
+
+def basin_offsets(basin_ids):
+    """
+    Creates the offset table of an array that is sorted by basin
+
+    :param basin_ids: sorted basin ids of the rows
+    :return: dictionary with the first and last (exclusive) row of each basin
+    """
+    basin_ids = np.asarray(basin_ids)
+    if basin_ids.shape[0] == 0:
+        return {}
+
+    starts = np.flatnonzero(np.append(True, basin_ids[1:] != basin_ids[:-1]))
+    stops = np.append(starts[1:], basin_ids.shape[0])
+
+    return dict(zip(basin_ids[starts].tolist(),
+                    zip(starts.tolist(), stops.tolist())))
+
@@ -0,0 +1,320 @@
+"""
+This module compiles the stream network into a network bundle, a folder of
+.npy files, so that the stream feature class is read through an arcpy cursor
+only once instead of once per stage (DOF, DOR, SED and every CSI scenario).
+
+Each field of the stream feature class is stored in its own .npy file. A
+stage opens only the fields it needs as memory maps (see load_fields) and
+copies them into a new stream array. Fields that are not yet in the bundle
+are read from the feature class and added to it. Null values are handled
+the same way as when the feature class is read directly, so a field read
+with null_value=0 and the same field read without null_value are stored as
+two columns (see column_name).
+
+The bundle also holds the topology of the whole network, with the routing
+index updated (see tools.topology.save_topology), so that the topology does
+not have to be rebuilt from the stream array either.
+
+A manifest records the fields of the bundle and a signature of the source
+feature class. If the signature changes, for example because the DOF values
+were written back into the feature class, the bundle is compiled again.
+
+Bundles can also be kept in a cache folder, with one bundle per stream
+feature class and version of it (see cache_entry).
+"""
+
+import hashlib
+import os
+import shutil
+
+import arcpy
+import numpy as np
+
+import tools.helper as tool
+import tools.topology as topology
+from config import config
+
+fd = config.var
+
+# Fields needed to build the topology, always part of the bundle
+ROUTING_FIELDS = [fd.GOID, fd.NOID, fd.NDOID, fd.BAS_ID]
+
+# Name prefix of the bundle folders in a cache folder, see cache_entry
+CACHE_PREFIX = "bundle_"
+
+# Version of the bundle layout. Bundles of another version are compiled again
+BUNDLE_VERSION = 2
+
+
+def load_fields(stream_table, fields, folder, null_value=None):
+    """
+    Loads fields of the stream feature class into a numpy array. If a bundle
+    folder is given, the fields are loaded from the bundle, which is compiled
+    or extended first if needed
+
+    :param stream_table: stream feature class
+    :param fields: list of fields to load
+    :param folder: folder of the network bundle, empty to read the feature
+        class directly
+    :param null_value: value of null values, see
+        arcpy.da.TableToNumPyArray. None to read them as the feature class
+        returns them
+    :return: numpy array
+    """
+    if not folder:
+        return read_table(stream_table, fields, null_value)
+
+    manifest = update_bundle(stream_table, fields, folder, null_value)
+
+    columns = [open_column(folder, column_name(f, null_value))
+               for f in fields]
+
+    arr = np.empty(manifest["rows"],
+                   dtype=[(str(f), c.dtype) for f, c in zip(fields, columns)])
+    for f, c in zip(fields, columns):
+        arr[f] = c
+    return arr
+
+
+def read_table(stream_table, fields, null_value=None):
+    """
+    Reads fields of the stream feature class
+
+    :param stream_table: stream feature class
+    :param fields: list of fields
+    :param null_value: value of null values, None to keep the default of
+        arcpy.da.TableToNumPyArray
+    :return: numpy array
+    """
+    if null_value is None:
+        return arcpy.da.TableToNumPyArray(stream_table, fields)
+    return arcpy.da.TableToNumPyArray(stream_table, fields,
+                                      null_value=null_value)
+
+
+def column_name(field, null_value=None):
+    """
+    Name of the .npy file of a field in the bundle, without extension. The
+    name depends on how null values were read, see read_table
+
+    :param field: field name
+    :param null_value: value of null values, None for the default
+    :return: column name
+    """
+    if null_value is None:
+        return field
+    return "{}.null_{}".format(field, null_value)
+
+
+def load_topology(stream_table, folder):
+    """
+    Loads the topology of the whole stream network from the bundle. The
+    topology matches a stream array that holds all reaches in the order of
+    the feature class, after tools.helper.update_stream_routing_index
+
+    :param stream_table: stream feature class
+    :param folder: folder of the network bundle
+    :return: tools.topology.Topology
+    """
+    update_bundle(stream_table, [], folder)
+    return topology.load_topology(os.path.join(folder, "topology"))
+
+
+def cache_entry(cache_folder, stream_table, keep=2):
+    """
+    Returns the bundle folder of a stream feature class in a cache folder.
+    The bundle is named after the signature of the feature class, so that a
+    changed feature class gets a new bundle instead of a stale one. Only the
+    most recently used bundles are kept, older ones are deleted. Folders
+    that were not created here (without the CACHE_PREFIX) are left alone
+
+    :param cache_folder: cache folder
+    :param stream_table: stream feature class
+    :param keep: number of bundles to keep
+    :return: bundle folder, see load_fields
+    """
+    name = CACHE_PREFIX + source_signature(stream_table)
+    folder = os.path.join(cache_folder, name)
+    tool.create_path(folder)
+
+    # The modification time of a bundle folder marks its last use
+    os.utime(folder, None)
+
+    entries = [os.path.join(cache_folder, f)
+               for f in os.listdir(cache_folder)
+               if f.startswith(CACHE_PREFIX) and f != name]
+    entries = [f for f in entries if os.path.isdir(f)]
+    entries.sort(key=os.path.getmtime, reverse=True)
+
+    for old in entries[max(keep - 1, 0):]:
+        print ("Removing network bundle {} from cache".format(old))
+        shutil.rmtree(old, ignore_errors=True)
+
+    return folder
+
+
+def open_column(folder, field):
+    """
+    Opens a field of the bundle as read only memory map
+
+    :param folder: folder of the network bundle
+    :param field: column name, see column_name
+    :return: numpy array
+    """
+    return np.load(os.path.join(folder, field + ".npy"), mmap_mode="r")
+
+
+def update_bundle(stream_table, fields, folder, null_value=None):
+    """
+    Makes sure that the bundle is up to date with the stream feature class
+    and holds the given fields
+
+    :param stream_table: stream feature class
+    :param fields: list of fields
+    :param folder: folder of the network bundle
+    :param null_value: value of null values of the fields, see read_table
+    :return: manifest of the bundle
+    """
+    signature = source_signature(stream_table)
+    manifest = tool.load_cpickle(folder, "manifest", ".pkl")
+
+    if manifest is None or manifest["signature"] != signature or \
+            manifest.get("version") != BUNDLE_VERSION:
+        return compile_network(stream_table, fields, folder, signature,
+                               null_value)
+
+    missing = [f for f in fields
+               if column_name(f, null_value) not in manifest["fields"]]
+    if missing:
+        manifest = add_columns(stream_table, missing, folder, manifest,
+                               null_value)
+
+    return manifest
+
+
+def compile_network(stream_table, fields, folder, signature,
+                    null_value=None):
+    """
+    Reads the stream feature class and writes the fields and the topology
+    of the network to the bundle folder
+
+    :param stream_table: stream feature class
+    :param fields: list of fields
+    :param folder: folder of the network bundle
+    :param signature: signature of the stream feature class
+    :param null_value: value of null values of the fields, see read_table
+    :return: manifest of the bundle
+    """
+    print ("Compiling network bundle {}".format(folder))
+
+    tool.create_path(folder)
+
+    # An interrupted compilation must not leave a valid manifest behind
+    manifest_file = os.path.join(folder, "manifest.pkl")
+    if os.path.isfile(manifest_file):
+        os.remove(manifest_file)
+
+    flds = ROUTING_FIELDS + [f for f in fields if f not in ROUTING_FIELDS]
+    arr = read_table(stream_table, flds, null_value)
+
+    columns = [column_name(f, null_value) for f in flds]
+    for f, column in zip(flds, columns):
+        np.save(os.path.join(folder, column + ".npy"), arr[f])
+
+    routing = arr[ROUTING_FIELDS].copy()
+    tool.update_stream_routing_index(routing)
+    topo = topology.build_topology(routing)
+    topology.save_topology(topo, os.path.join(folder, "topology"))
+
+    # The GOIDs of the rows, whatever the null values of the fields
+    np.save(os.path.join(folder, "rows.npy"), arr[fd.GOID])
+
+    manifest = {"version": BUNDLE_VERSION,
+                "signature": signature,
+                "rows": arr.shape[0],
+                "fields": columns}
+    tool.save_as_cpickle(manifest, folder, "manifest", ".pkl")
+    return manifest
+
+
+def add_columns(stream_table, fields, folder, manifest, null_value=None):
+    """
+    Reads fields that are missing from the bundle from the stream feature
+    class and adds them to the bundle
+
+    :param stream_table: stream feature class
+    :param fields: list of fields to add
+    :param folder: folder of the network bundle
+    :param manifest: manifest of the bundle
+    :param null_value: value of null values of the fields, see read_table
+    :return: updated manifest
+    """
+    print ("Adding {} to network bundle".format(", ".join(fields)))
+
+    flds = [fd.GOID] + [f for f in fields if f != fd.GOID]
+    arr = read_table(stream_table, flds, null_value)
+
+    # The rows must come in the same order as when the bundle was compiled.
+    # Otherwise the bundle is compiled again, with these fields only
+    if not np.array_equal(arr[fd.GOID], open_column(folder, "rows")):
+        return compile_network(stream_table, fields, folder,
+                               manifest["signature"], null_value)
+
+    columns = [column_name(f, null_value) for f in fields]
+    for f, column in zip(fields, columns):
+        np.save(os.path.join(folder, column + ".npy"), arr[f])
+
+    manifest["fields"] = manifest["fields"] + columns
+    tool.save_as_cpickle(manifest, folder, "manifest", ".pkl")
+    return manifest
+
+
+def source_signature(stream_table):
+    """
+    Signature of the stream feature class. Hashing the content would need a
+    full read of the table, which is what the bundle avoids. The signature
+    is therefore built from the path, the fields, the number of rows and the
+    time of the last change of the geodatabase or shapefile, see
+    last_modified
+
+    :param stream_table: stream feature class
+    :return: signature as hex string
+    """
+    fields = [(f.name, f.type) for f in arcpy.ListFields(stream_table)]
+    count = int(arcpy.GetCount_management(stream_table).getOutput(0))
+    source = os.path.normcase(os.path.abspath(stream_table))
+
+    desc = repr((source, fields, count, last_modified(source)))
+    return hashlib.md5(desc).hexdigest()
+
+
+def last_modified(path):
+    """
+    Time of the last change of a file and the files that belong to it (e.g.
+    the .dbf and .shx of a shapefile), or of the files of the geodatabase
+    that holds a feature class. Lock files are ignored, since they are
+    created when the geodatabase or shapefile is read
+
+    :param path: path of a file or feature class
+    :return: modification time, None if the path cannot be found
+    """
+    while path and not os.path.exists(path):
+        parent = os.path.dirname(path)
+        if parent == path:
+            return None
+        path = parent
+
+    if not path:
+        return None
+
+    if not os.path.isdir(path):
+        folder = os.path.dirname(path) or "."
+        base = os.path.splitext(os.path.basename(path))[0] + "."
+        stamps = [os.path.getmtime(os.path.join(folder, f))
+                  for f in os.listdir(folder)
+                  if f.startswith(base) and not f.endswith(".lock")]
+        return max(stamps + [os.path.getmtime(path)])
+
+    stamps = [os.path.getmtime(os.path.join(path, f))
+              for f in os.listdir(path) if not f.endswith(".lock")]
+    return max(stamps) if stamps else None
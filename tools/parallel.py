@@ -0,0 +1,481 @@
+"""
+This module holds the helpers to run the basin-wise calculations (DOF, DOR
+and SED) in a pool of worker processes.
+
+The global stream and dam arrays are sorted by basin once and written to
+.npy files in the scratch workspace (see share_array). The workers map these
+files into memory (read only) and receive only the first and last row of
+their basin. The arrays are therefore neither pickled for every basin nor
+copied into every worker; a worker only holds a copy of the basin it is
+working on.
+
+The results are written the same way: the workers write the result fields
+of their basin directly into an output .npy file with the same rows as the
+shared stream array, see create_output and collect_results.
+
+The basins are handed to the pool largest first (see basin_costs), so that
+the largest basins do not start last and leave the other workers idle.
+Small basins are bundled into tasks of similar size, so that the pool is not
+flooded with tens of thousands of tiny tasks (see make_tasks). For results
+that are a maximum over dams (DOF), the dams of very large basins can be
+split over several tasks. Each task then writes a partial result into its
+own slot of a second file, and the partial results are combined in the
+output file (see merge_partials).
+
+The tasks are submitted with bounded_map, which keeps only a limited number
+of tasks in flight and hands back the results as they complete.
+"""
+
+import os
+import traceback
+
+import numpy as np
+
+import tools.helper as tool
+from config import config
+
+fd = config.var
+
+# Memory maps opened by this process, by path
+_shared = {}
+
+# A basin is only split over several tasks if it costs at least this many
+# average tasks, see make_tasks
+SPLIT_FACTOR = 2
+
+
+def share_array(array, folder, name):
+    """
+    Writes an array to a .npy file that worker processes can map into
+    memory, see load_basin. The array should be sorted by basin (see
+    tools.helper.sort_by_basin), so that each basin is a block of rows
+
+    :param array: numpy array
+    :param folder: folder for the file, usually the scratch workspace
+    :param name: name of the file
+    :return: path of the file
+    """
+    path = os.path.join(folder, name + ".npy")
+    np.save(path, array)
+    return path
+
+
+def basin_rows(rows, basin):
+    """
+    First and last (exclusive) row of a basin, see
+    tools.helper.sort_by_basin. Basins that are not in the file have no rows
+
+    :param rows: dictionary of rows by basin
+    :param basin: river basin
+    :return: tuple of first and last row
+    """
+    return rows.get(basin, (0, 0))
+
+
+def basin_costs(streams, dams, stream_rows):
+    """
+    Estimates the processing time of each basin from its number of reaches,
+    its number of dams and how far upstream the dams reach. The number of
+    reaches upstream of a dam grows roughly with its discharge, so the
+    upstream extent of a dam is estimated as its share of the largest
+    discharge in the basin, times the number of reaches in the basin
+
+    :param streams: numpy array of the stream network, sorted by basin
+    :param dams: numpy array of the dams
+    :param stream_rows: dictionary of stream rows by basin
+    :return: dictionary of costs by basin
+    """
+    basins = np.array(sorted(stream_rows), dtype=streams.dtype[fd.BAS_ID])
+    if basins.shape[0] == 0:
+        return {}
+
+    starts = np.array([stream_rows[b][0] for b in basins.tolist()])
+    stops = np.array([stream_rows[b][1] for b in basins.tolist()])
+    n_reaches = stops - starts
+    max_dis = np.maximum.reduceat(streams[fd.DIS_AV_CMS], starts)
+
+    # Discharge and basin of each dam
+    rows = tool.find_rows(streams[fd.GOID], dams[fd.GOID])
+    found = rows >= 0
+    dam_dis = streams[fd.DIS_AV_CMS][np.maximum(rows, 0)]
+
+    b = np.minimum(np.searchsorted(basins, dams[fd.BAS_ID]),
+                   basins.shape[0] - 1)
+    found &= basins[b] == dams[fd.BAS_ID]
+    b = b[found]
+
+    share = np.zeros(b.shape[0])
+    has_dis = max_dis[b] > 0
+    share[has_dis] = dam_dis[found][has_dis] / max_dis[b][has_dis]
+
+    costs = n_reaches.astype(np.float64)
+    np.add.at(costs, b, 1 + share * n_reaches[b])
+
+    return dict(zip(basins.tolist(), costs.tolist()))
+
+
+def largest_first(basins, costs):
+    """
+    Sorts the basins by their estimated cost, largest first
+
+    :param basins: list of basins
+    :param costs: dictionary of costs by basin, see basin_costs
+    :return: sorted list of basins
+    """
+    return sorted(basins, key=lambda basin: -costs.get(basin, 0))
+
+
+def make_tasks(basins, costs, stream_rows, dam_rows, n_tasks, max_parts=1):
+    """
+    Groups the basins into about n_tasks tasks of similar cost. A basin that
+    costs at least the average task is a task of its own, smaller basins are
+    bundled until the bundle reaches the average. The tasks are returned
+    largest first.
+
+    If max_parts is larger than one, the dams of a basin that costs at
+    least SPLIT_FACTOR average tasks are split over up to max_parts tasks.
+    This is only valid if the result of a basin is the maximum of the
+    results of its dams. Each part gets its own slot of rows in the file of
+    partial results, see slot_rows
+
+    :param basins: list of basins
+    :param costs: dictionary of costs by basin, see basin_costs
+    :param stream_rows: dictionary of stream rows by basin
+    :param dam_rows: dictionary of dam rows by basin
+    :param n_tasks: number of tasks to aim for
+    :param max_parts: largest number of tasks a basin is split into
+    :return: list of tasks. A task is a list of (basin, stream rows, dam
+        rows, slot), see run_bundle. The slot is the first row of a part in
+        the file of partial results, None for whole basins
+    """
+    basins = largest_first(basins, costs)
+    target = float(sum(costs.get(b, 0) for b in basins)) / max(n_tasks, 1)
+
+    tasks = []
+    bundle = []
+    bundle_cost = 0
+    slot = 0
+    for basin in basins:
+        cost = costs.get(basin, 0)
+        start, stop = basin_rows(dam_rows, basin)
+
+        if target > 0 and cost >= SPLIT_FACTOR * target:
+            parts = min(int(cost / target), max_parts, stop - start)
+        else:
+            parts = 1
+
+        if parts > 1:
+            first, last = basin_rows(stream_rows, basin)
+            bounds = np.linspace(start, stop, parts + 1).astype(np.int64)
+            for k in range(parts):
+                tasks.append((cost / parts, [(
+                    basin, (first, last),
+                    (int(bounds[k]), int(bounds[k + 1])), slot)]))
+                slot += last - first
+            continue
+
+        bundle.append((basin, basin_rows(stream_rows, basin), (start, stop),
+                       None))
+        bundle_cost += cost
+
+        if bundle_cost >= target:
+            tasks.append((bundle_cost, bundle))
+            bundle = []
+            bundle_cost = 0
+
+    if bundle:
+        tasks.append((bundle_cost, bundle))
+
+    tasks.sort(key=lambda task: -task[0])
+    return [task_bundle for task_cost, task_bundle in tasks]
+
+
+def slot_rows(tasks):
+    """
+    Number of rows of the file of partial results, see make_tasks
+
+    :param tasks: list of tasks from make_tasks
+    :return: number of rows, 0 if no basin is split
+    """
+    rows = 0
+    for bundle in tasks:
+        for basin, (start, stop), dam_rows, slot in bundle:
+            if slot is not None:
+                rows = max(rows, slot + stop - start)
+    return rows
+
+
+def create_output(folder, name, n, fields, dtype="f4"):
+    """
+    Creates the output file for the results of the workers, with one row per
+    row of the shared stream array. All values start at zero
+
+    :param folder: folder for the file, usually the scratch workspace
+    :param name: name of the file
+    :param n: number of rows
+    :param fields: names of the result fields
+    :param dtype: data type of the result fields
+    :return: path of the file
+    """
+    path = os.path.join(folder, name + ".npy")
+    out = np.lib.format.open_memmap(path, mode="w+", shape=(n,),
+                                    dtype=[(str(f), dtype) for f in fields])
+    out[:] = 0
+    del out
+    return path
+
+
+def collect_results(streams_path, output_path, rows):
+    """
+    Collects the results of the workers from the output file. Only the rows
+    of the given basins are returned, sorted by GOID
+
+    :param streams_path: path of the shared stream array
+    :param output_path: path of the output file
+    :param rows: list of the first and last row of each processed basin
+    :return: numpy array with the field GOID and the result fields
+    """
+    release_shared()
+
+    streams = np.load(streams_path, mmap_mode="r")
+    output = np.load(output_path, mmap_mode="r")
+
+    sel = np.zeros(streams.shape[0], dtype=np.bool_)
+    for start, stop in rows:
+        sel[start:stop] = True
+
+    goid = streams[fd.GOID][sel]
+    order = np.argsort(goid, kind="mergesort")
+
+    results = np.zeros(goid.shape[0],
+                       dtype=[(fd.GOID, streams.dtype[fd.GOID])] +
+                             output.dtype.descr)
+    results[fd.GOID] = goid[order]
+    for f in output.dtype.names:
+        results[f] = output[f][sel][order]
+
+    del streams
+    del output
+
+    return results
+
+
+def merge_partials(output_path, results, parts_path=None):
+    """
+    Combines the results of the tasks, see run_bundle. Partial results of
+    split basins are read from their slots in the file of partial results,
+    and merged into the output file by element-wise maximum
+
+    :param output_path: path of the output file
+    :param results: iterable of the return values of run_bundle
+    :param parts_path: path of the file of partial results, see slot_rows.
+        None if no basin is split
+    :return: list of the first and last row of each processed basin
+    """
+    out = _open(output_path, "r+")
+
+    rows = []
+    for rows_of_basins, partials in results:
+        rows += rows_of_basins
+        for (start, stop), slot in partials:
+            part = _open(parts_path, "r")[slot:slot + stop - start]
+            for f in out.dtype.names:
+                out[f][start:stop] = np.maximum(out[f][start:stop], part[f])
+            rows.append((start, stop))
+
+    return rows
+
+
+def bounded_map(pool, func, args_iter, max_in_flight, poll=1.0):
+    """
+    Runs func(*args) in the pool for every args from args_iter, like
+    pool.imap_unordered. Unlike imap_unordered, at most max_in_flight tasks
+    are submitted at a time, and args_iter is only consumed as tasks
+    complete.
+
+    Errors are raised in the calling process: errors of func, results that
+    cannot be sent back, and worker processes that die (e.g. killed when
+    out of memory), whose tasks would otherwise never complete
+
+    :param pool: multiprocessing pool
+    :param func: function to run, must be defined at module level
+    :param args_iter: iterable of argument tuples
+    :param max_in_flight: largest number of tasks submitted at a time
+    :param poll: seconds between checks of the worker processes
+    :return: generator of the return values, in order of completion
+    """
+    pids = _worker_pids(pool)
+    pending = []
+
+    for args in args_iter:
+        if len(pending) >= max_in_flight:
+            yield _next_result(pool, pending, pids, poll)
+
+        pending.append(pool.apply_async(_call, (func, args)))
+
+    while pending:
+        yield _next_result(pool, pending, pids, poll)
+
+
+def _call(func, args):
+    """
+    Runs a task in a worker. Errors are returned with their traceback, which
+    is lost if the exception is raised in the worker
+    """
+    try:
+        return True, func(*args)
+    except Exception:
+        return False, traceback.format_exc()
+
+
+def _next_result(pool, pending, pids, poll):
+    """
+    Waits for the next completed task of bounded_map, and removes it from
+    the pending tasks
+    """
+    while True:
+        for k, task in enumerate(pending):
+            if task.ready():
+                del pending[k]
+                # Raises if the result could not be sent back
+                ok, result = task.get()
+                if not ok:
+                    raise Exception("A worker failed:\n{}".format(result))
+                return result
+
+        pending[0].wait(poll)
+        _check_workers(pool, pids)
+
+
+def _worker_pids(pool):
+    """
+    Process ids of the workers of a pool
+    """
+    return set(p.pid for p in pool._pool)
+
+
+def _check_workers(pool, pids):
+    """
+    Raises if a worker process died, or if the pool can no longer receive
+    results. The pool replaces a dead worker, but the task it was running
+    is lost and would never complete
+    """
+    if any(p.exitcode is not None for p in pool._pool) or \
+            _worker_pids(pool) != pids:
+        raise Exception("A worker process exited unexpectedly, e.g. because "
+                        "it ran out of memory")
+
+    if not pool._result_handler.is_alive():
+        raise Exception("The results of the workers can no longer be "
+                        "received")
+
+
+def load_basin(path, start, stop):
+    """
+    Returns a copy of the rows of one basin from a file written by
+    share_array. The file is mapped into memory once per process
+
+    :param path: path of the file
+    :param start: first row of the basin
+    :param stop: last row of the basin (exclusive)
+    :return: numpy array
+    """
+    return np.array(_open(path, "r")[start:stop])
+
+
+def write_basin(path, start, stop, result):
+    """
+    Writes the results of one basin into the output file, see create_output
+
+    :param path: path of the output file
+    :param start: first row of the basin
+    :param stop: last row of the basin (exclusive)
+    :param result: numpy array with the rows of the basin, holding (at
+        least) the fields of the output file
+    """
+    out = _open(path, "r+")
+    for f in out.dtype.names:
+        out[f][start:stop] = result[f]
+
+
+def _open(path, mode):
+    """
+    Maps a .npy file into memory, once per process and mode
+    """
+    arr = _shared.get((path, mode))
+    if arr is None:
+        arr = np.load(path, mmap_mode=mode)
+        _shared[(path, mode)] = arr
+    return arr
+
+
+def release_shared():
+    """
+    Closes the memory maps of this process, so that the files can be
+    deleted
+    """
+    _shared.clear()
+
+
+def run_shared(func, streams_path, stream_rows, dams_path, dam_rows,
+               output_path, args):
+    """
+    Runs a basin calculation in a worker. Loads the streams and dams of the
+    basin, calls func(streams, dams, *args) and writes the stream array it
+    returns into the output file
+
+    :param func: function to run, must be defined at module level
+    :param streams_path: path of the shared stream array
+    :param stream_rows: first and last row of the basin in the streams
+    :param dams_path: path of the shared dam array
+    :param dam_rows: first and last row of the basin in the dams
+    :param output_path: path of the output file
+    :param args: further arguments of func
+    :return: first and last row of the basin in the streams
+    """
+    streams = load_basin(streams_path, *stream_rows)
+    dams = load_basin(dams_path, *dam_rows)
+
+    result = func(streams, dams, *args)
+    write_basin(output_path, stream_rows[0], stream_rows[1], result)
+
+    return stream_rows
+
+
+def run_bundle(func, streams_path, dams_path, output_path, bundle, args,
+               parts_path=None):
+    """
+    Runs a basin calculation for a bundle of basins in one worker call, see
+    run_shared and make_tasks. For each basin, calls
+    func(streams, dams, basin, *args). The results of whole basins are
+    written into the output file, the results of split basins into their
+    slot of the file of partial results, see merge_partials
+
+    :param func: function to run, must be defined at module level
+    :param streams_path: path of the shared stream array
+    :param dams_path: path of the shared dam array
+    :param output_path: path of the output file
+    :param bundle: list of (basin, stream rows, dam rows, slot)
+    :param args: further arguments of func, the same for all basins
+    :param parts_path: path of the file of partial results, see slot_rows.
+        None if no basin is split
+    :return: list of the first and last row of each whole basin, and list of
+        the rows and slots of split basins
+    """
+    rows = []
+    partials = []
+    for basin, stream_rows, dam_rows, slot in bundle:
+        if slot is None:
+            rows.append(run_shared(func, streams_path, stream_rows,
+                                   dams_path, dam_rows, output_path,
+                                   (basin,) + tuple(args)))
+            continue
+
+        streams = load_basin(streams_path, *stream_rows)
+        dams = load_basin(dams_path, *dam_rows)
+        result = func(streams, dams, basin, *args)
+
+        write_basin(parts_path, slot, slot + result.shape[0], result)
+        partials.append((stream_rows, slot))
+
+    return rows, partials
@@ -0,0 +1,133 @@
+"""
+This module holds the state of a model run that is shared between the
+stages (DOF, DOR, SED and CSI).
+
+Without a session, each stage writes its results back into the stream
+feature class, and the CSI calculation reads them from there again. With a
+session, the results are handed over in memory (see Session.hand_off and
+Session.apply), and the stream feature class is updated once, at the end of
+the run or before it is needed for an export (see Session.flush).
+
+The session also reads the dam table once for all stages (see
+Session.load_dams).
+"""
+
+from collections import OrderedDict
+
+import arcpy
+
+import tools.helper as tool
+from config import config
+
+fd = config.var
+
+
+class Session(object):
+    """
+    Results handed over between the stages of one model run
+
+    results: for each field of the stream feature class, the GOIDs and the
+        new values of the reaches, and how to write them back (see
+        hand_off)
+    pending: fields that are not yet written back into the stream feature
+        class
+    dams: the dam tables that were read, by path
+    """
+
+    def __init__(self, stream_table, write_back=True, dam_fields=()):
+        """
+        :param stream_table: stream feature class
+        :param write_back: if False, the results are only handed over in
+            memory, and the stream feature class is never updated
+        :param dam_fields: fields of the dam table that are read in any
+            case, so that all stages can use the same read (see load_dams)
+        """
+        self.stream_table = stream_table
+        self.write_back = write_back
+        self.dam_fields = list(dam_fields)
+
+        self.results = OrderedDict()
+        self.pending = []
+        self.dams = {}
+
+    def load_dams(self, dam_table, fields):
+        """
+        Reads the dam table with tools.helper.load_dam_table. The table is
+        read with the given fields and those of dam_fields that exist in the
+        table, and is kept for the next stages. It is only read again if a
+        stage needs a field that was not read
+
+        :param dam_table: dam table or feature class
+        :param fields: list of fields the stage needs
+        :return: numpy array with all dams. The array is shared, and must
+            not be changed
+        """
+        dams = self.dams.get(dam_table)
+        if dams is not None and set(fields) <= set(dams.dtype.names):
+            return dams
+
+        existing = [f.name for f in arcpy.ListFields(dam_table)]
+
+        flds = list(fields)
+        if dams is not None:
+            flds += list(dams.dtype.names)
+        flds += [f for f in self.dam_fields if f in existing]
+        flds = [f for i, f in enumerate(flds) if f not in flds[:i]]
+
+        dams = tool.load_dam_table(dam_table, flds)
+        self.dams[dam_table] = dams
+        return dams
+
+    def hand_off(self, field, goids, values, over_mode=True, over_value=0):
+        """
+        Hands over the results of a stage. The results are written back with
+        tools.helper.update_columns, see flush
+
+        :param field: field of the stream feature class to update
+        :param goids: GOIDs of the reaches
+        :param values: new values of the reaches
+        :param over_mode: if True, the reaches that are not in the results
+            are set to over_value, otherwise they keep their value
+        :param over_value: value of the reaches that are not in the results
+        """
+        self.results[field] = (goids, values, over_mode, over_value)
+        if field not in self.pending:
+            self.pending.append(field)
+
+    def apply(self, streams):
+        """
+        Copies the results that were handed over into a stream array, in the
+        same way as they would be copied into the stream feature class
+
+        :param streams: numpy array of the stream network
+        :return: the updated stream array
+        """
+        for field, result in self.results.items():
+            if field not in streams.dtype.names:
+                continue
+
+            goids, values, over_mode, over_value = result
+
+            rows = tool.find_rows(goids, streams[fd.GOID])
+            found = rows >= 0
+
+            if over_mode is True:
+                streams[field][~found] = over_value
+            streams[field][found] = values[rows[found]]
+
+        return streams
+
+    def flush(self):
+        """
+        Writes the results that were handed over, and not yet written, back
+        into the stream feature class. All fields are written in one pass
+        """
+        if self.write_back and self.pending:
+            print ("Updating {} values in database {} ".format(
+                ", ".join(self.pending), self.stream_table))
+
+            tool.update_columns(self.stream_table,
+                                [(field,) + self.results[field]
+                                 for field in self.pending])
+
+        self.pending = []
@@ -0,0 +1,241 @@
+"""
+This module compiles the routing fields of a stream network into integer
+arrays.
+
+The stream network stores its topology in the fields NOID, NDOID and NUOID.
+The upstream direction is encoded as a string of network ids joined by
+underscores (e.g. "12_13"), which has to be split every time a routing loop
+moves upstream. The Topology object holds the same information as integer
+arrays, is built once from the stream array and is then shared by the
+DOF, DOR, SED and STA calculations. The arrays of a Topology can be written
+to .npy files and opened again as memory maps, see save_topology.
+
+All indices in the Topology are zero-based positions in the stream array,
+i.e. the reach with the network id NOID is found at position NOID - 1.
+"""
+
+import os
+
+import numpy as np
+
+from config import config
+
+fd = config.var
+
+
+class Topology(object):
+    """
+    Integer topology of a stream network
+
+    down: position of the next downstream reach, -1 for outlets
+    up_ptr, up_idx: upstream reaches in compressed sparse row (CSR) format.
+        The reaches directly upstream of reach i are
+        up_idx[up_ptr[i]:up_ptr[i + 1]]
+    order: positions of all reaches in topological order, from the
+        headwaters to the outlets
+    level_ptr: offsets into order that delimit the generations of reaches.
+        A reach only drains into reaches of later generations, so all
+        reaches of one generation can be processed at once
+
+    A nested set index (depth-first pre-order) of the network is built on
+    first use, see nested_set()
+    """
+
+    def __init__(self, down):
+        """
+        :param down: position of the next downstream reach, -1 for outlets
+        """
+        self.down = np.asarray(down, dtype=np.int64)
+        self.n = self.down.shape[0]
+
+        self.up_ptr, self.up_idx = _upstream_csr(self.down)
+        self.order, self.level_ptr = _topological_levels(self.down,
+                                                         self.up_ptr)
+
+        self._nested = None
+
+    def outlets(self):
+        """
+        Positions of all reaches without a downstream reach
+        """
+        return np.flatnonzero(self.down < 0)
+
+    def levels(self):
+        """
+        Iterates over the generations of reaches, from the headwaters to
+        the outlets
+        """
+        for k in range(len(self.level_ptr) - 1):
+            yield self.order[self.level_ptr[k]:self.level_ptr[k + 1]]
+
+    def nested_set(self):
+        """
+        Nested set index of the network. The reaches are numbered in
+        depth-first pre-order, so that all reaches upstream of reach i,
+        including i itself, form one contiguous range:
+
+        euler[pre[i]:pre[i] + size[i]]
+
+        :return: pre (pre-order number of each reach), size (number of
+            reaches upstream of and including each reach), euler (reach
+            positions in pre-order)
+        """
+        if self._nested is None:
+            self._nested = _nested_set(self.down, self.up_ptr, self.up_idx,
+                                       self.levels())
+        return self._nested
+
+
+# Arrays written by save_topology
+_ARRAYS = ["down", "up_ptr", "up_idx", "order", "level_ptr"]
+_NESTED = ["pre", "size", "euler"]
+
+
+def build_topology(streams):
+    """
+    Builds the topology from a stream array whose network ids match the
+    array positions, i.e. after the routing index has been updated with
+    tools.helper.update_stream_routing_index
+
+    :param streams: numpy array representing the stream network
+    :return: Topology
+    """
+    down = streams[fd.NDOID].astype(np.int64) - 1
+
+    return Topology(down)
+
+
+def save_topology(topo, folder):
+    """
+    Writes the arrays of a topology, including the nested set index, to
+    .npy files in a folder
+
+    :param topo: Topology
+    :param folder: output folder
+    """
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+
+    arrays = [getattr(topo, name) for name in _ARRAYS] + \
+             list(topo.nested_set())
+    for name, array in zip(_ARRAYS + _NESTED, arrays):
+        np.save(os.path.join(folder, name + ".npy"), array)
+
+
+def load_topology(folder):
+    """
+    Opens a topology written by save_topology. The arrays are memory mapped
+    read only, and nothing is recalculated
+
+    :param folder: folder of the topology
+    :return: Topology
+    """
+    def load(name):
+        return np.load(os.path.join(folder, name + ".npy"), mmap_mode="r")
+
+    # The arrays are set directly instead of being built in __init__
+    topo = Topology.__new__(Topology)
+    for name in _ARRAYS:
+        setattr(topo, name, load(name))
+    topo.n = topo.down.shape[0]
+    topo._nested = tuple(load(name) for name in _NESTED)
+    return topo
+
+
+def _upstream_csr(down):
+    """
+    Groups the reaches by their downstream reach. Upstream reaches keep their
+    original order, which is the order they had in the NUOID field.
+    """
+    n = down.shape[0]
+    has_down = np.flatnonzero(down >= 0)
+
+    counts = np.bincount(down[has_down], minlength=n)
+    up_ptr = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(counts, out=up_ptr[1:])
+
+    up_idx = has_down[np.argsort(down[has_down], kind="mergesort")]
+
+    return up_ptr, up_idx
+
+
+def _nested_set(down, up_ptr, up_idx, levels):
+    """
+    Numbers the reaches in depth-first pre-order without walking the tree.
+
+    1) The size of each upstream tree is accumulated generation by
+       generation.
+    2) The pre-order number of a reach is the number of its downstream
+       reach plus one plus the sizes of the upstream trees of its siblings
+       that come before it. This offset is computed for all reaches at
+       once, and then summed along the path to the outlet by pointer
+       jumping (log2 of the longest path iterations).
+    """
+    n = down.shape[0]
+
+    size = np.ones(n, dtype=np.int64)
+    for level in levels:
+        dw = down[level]
+        has_down = dw >= 0
+        if has_down.any():
+            dw, inv = np.unique(dw[has_down], return_inverse=True)
+            size[dw] += np.bincount(
+                inv, weights=size[level[has_down]]).astype(np.int64)
+
+    rel = np.zeros(n, dtype=np.int64)
+
+    sibling_sum = np.zeros(up_idx.shape[0] + 1, dtype=np.int64)
+    np.cumsum(size[up_idx], out=sibling_sum[1:])
+    first_sibling = up_ptr[down[up_idx]]
+    rel[up_idx] = 1 + sibling_sum[:-1] - sibling_sum[first_sibling]
+
+    # The outlets are numbered one after the other
+    outlets = np.flatnonzero(down < 0)
+    rel[outlets] = np.cumsum(size[outlets]) - size[outlets]
+
+    pre = rel
+    nxt = down.copy()
+    active = np.flatnonzero(nxt >= 0)
+    while active.size > 0:
+        pre[active] += pre[nxt[active]]
+        nxt[active] = nxt[nxt[active]]
+        active = active[nxt[active] >= 0]
+
+    euler = np.empty(n, dtype=np.int64)
+    euler[pre] = np.arange(n, dtype=np.int64)
+
+    return pre, size, euler
+
+
+def _topological_levels(down, up_ptr):
+    """
+    Sorts the reaches topologically (Kahn's algorithm), one generation at a
+    time. The first generation are the headwaters, and a reach joins the
+    next generation as soon as all of its upstream reaches are processed.
+    """
+    n = down.shape[0]
+    remaining = np.diff(up_ptr)
+
+    frontier = np.flatnonzero(remaining == 0)
+    chunks = []
+    level_ptr = [0]
+
+    while frontier.size > 0:
+        chunks.append(frontier)
+        level_ptr.append(level_ptr[-1] + frontier.size)
+
+        nxt = down[frontier]
+        nxt, cnt = np.unique(nxt[nxt >= 0], return_counts=True)
+        remaining[nxt] -= cnt
+        frontier = nxt[remaining[nxt] == 0]
+
+    if level_ptr[-1] != n:
+        raise Exception("The stream network contains loops. {} reaches "
+                        "could not be sorted".format(n - level_ptr[-1]))
+
+    if chunks:
+        order = np.concatenate(chunks)
+    else:
+        order = np.zeros(0, dtype=np.int64)
+
+    return order, np.array(level_ptr, dtype=np.int64)